@@ -5,11 +5,40 @@ from PyQt4.QtGui import *
 
 import qgis.core
 
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import timings
+
 class ConnectionManager:
 
   SUPPORTED_CONNECTORS = ['postgis', 'spatialite']
   MISSED_CONNECTORS = []
 
+  # what is known of a connector without importing it, the modules
+  # are imported when first used (see getConnection)
+  CONNECTORS_INFO = {
+    'postgis': { 'settingsKey': 'PostgreSQL', 'icon': 'postgis.png' },
+    'spatialite': { 'settingsKey': 'SpatiaLite', 'icon': 'spatialite.png' },
+  }
+  CONNECTOR_MODULES = {}
+  ICONS = {}
+
+  # the saved connections, see getRegistry()
+  REGISTRY = None
+
+  # pools of open connections, keyed by (conntype, connection name, uri)
+  POOLS = {}
+  POOLS_LOCK = threading.Lock()
+
+  # default pool options, see setPoolOptions()
+  POOL_MINSIZE = 1
+  POOL_MAXSIZE = 8
+  POOL_IDLE_TIMEOUT = 300  # seconds
+
   @classmethod
   def initConnectionSupport(self):
     conntypes = ConnectionManager.SUPPORTED_CONNECTORS
@@ -28,10 +57,36 @@ class ConnectionManager:
     if not self.isSupported(conntype):
       raise NotSupportedConnTypeException(conntype)
 
-    # import the connector
-    exec( "from connectors import %s as connector" % conntype)
+    connector = self.getConnectorModule( conntype )
     return connector.Connection(uri) if uri else connector.Connection
 
+  @classmethod
+  def getConnectorModule(self, conntype):
+    """ import the connector module, only the first time it's needed """
+    connector = ConnectionManager.CONNECTOR_MODULES.get( conntype )
+    if connector is None:
+      package = __name__.rpartition('.')[0]
+      name = "connectors.%s" % conntype
+      if package:
+        name = "%s.%s" % (package, name)
+      connector = timings.importModule( name )
+      ConnectionManager.CONNECTOR_MODULES[ conntype ] = connector
+    return connector
+
+  @classmethod
+  def getSettingsKey(self, conntype):
+    return ConnectionManager.CONNECTORS_INFO[ conntype ][ 'settingsKey' ]
+
+  @classmethod
+  def icon(self, conntype):
+    """ the icon of a connection type, loaded once """
+    icon = ConnectionManager.ICONS.get( conntype )
+    if icon is None:
+      path = os.path.join( os.path.dirname(__file__), ConnectionManager.CONNECTORS_INFO[ conntype ][ 'icon' ] )
+      icon = QIcon( path )
+      ConnectionManager.ICONS[ conntype ] = icon
+    return icon
+
   @classmethod
   def isSupported(self, conntype):
     return conntype in ConnectionManager.SUPPORTED_CONNECTORS
@@ -43,11 +98,389 @@ class ConnectionManager:
     if not hasattr(conntypes, '__iter__'):
       conntypes = [conntypes]
 
-    connections = []
     for c in conntypes:
-      connection = self.getConnection( c )
-      connections.extend( connection.getAvailableConnections() )
-    return connections
+      if not self.isSupported(c):
+        raise NotSupportedConnTypeException(c)
+
+    # the actions are kept by the registry, they are the same between calls
+    registry = self.getRegistry()
+    registry.update()
+    return [ a for a in registry.connections() if a.getTypeName() in conntypes ]
+
+  @classmethod
+  def getRegistry(self):
+    """ the registry of the saved connections, created when first needed """
+    if ConnectionManager.REGISTRY is None:
+      ConnectionManager.REGISTRY = ConnectionRegistry()
+    return ConnectionManager.REGISTRY
+
+  @classmethod
+  def setPoolOptions(self, minsize=None, maxsize=None, idle_timeout=None):
+    """ change the options of the connection pools, existing pools are updated too """
+    if minsize is not None:
+      ConnectionManager.POOL_MINSIZE = minsize
+    if maxsize is not None:
+      ConnectionManager.POOL_MAXSIZE = maxsize
+    if idle_timeout is not None:
+      ConnectionManager.POOL_IDLE_TIMEOUT = idle_timeout
+
+    ConnectionManager.POOLS_LOCK.acquire()
+    try:
+      for pool in ConnectionManager.POOLS.values():
+        pool.setOptions(ConnectionManager.POOL_MINSIZE, ConnectionManager.POOL_MAXSIZE, ConnectionManager.POOL_IDLE_TIMEOUT)
+    finally:
+      ConnectionManager.POOLS_LOCK.release()
+
+  @classmethod
+  def getPool(self, conntype, name, parent=None, interactive=True):
+    """ return the pool of the connection called 'name', creating it if needed.
+        Returns None if the user cancelled the password request. Without
+        interactive the password isn't asked: DbError if it's not saved """
+    connector = self.getConnection( conntype )
+    name = unicode(name)
+    uri = connector.getSettingsURI( name )
+    key = (conntype, name, unicode(uri.connectionInfo()))
+
+    ConnectionManager.POOLS_LOCK.acquire()
+    try:
+      pool = ConnectionManager.POOLS.get( key )
+    finally:
+      ConnectionManager.POOLS_LOCK.release()
+    if pool is not None:
+      return pool
+
+    # a password which isn't stored is asked only once per pool
+    if not interactive and not connector.isPasswordSaved( name ):
+      raise DbError( u'the password of connection "%s" is not saved' % name )
+    if not connector.requestPassword( name, uri, parent ):
+      return None
+
+    ConnectionManager.POOLS_LOCK.acquire()
+    try:
+      pool = ConnectionManager.POOLS.get( key )
+      if pool is None:
+        pool = ConnectionPool( lambda: self.openConnection( key, connector, uri ), ConnectionManager.POOL_MINSIZE,
+                               ConnectionManager.POOL_MAXSIZE, ConnectionManager.POOL_IDLE_TIMEOUT )
+        pool.key = key
+        ConnectionManager.POOLS[ key ] = pool
+    finally:
+      ConnectionManager.POOLS_LOCK.release()
+    return pool
+
+  @classmethod
+  def openConnection(self, key, connector, uri):
+    """ the factory of the pool 'key'. Until a connection succeeded the
+        password may be wrong: on failure the pool is dropped, with its
+        password, so that the next getPool() asks for it again """
+    try:
+      return connector( uri )
+    except DbError:
+      ConnectionManager.POOLS_LOCK.acquire()
+      try:
+        pool = ConnectionManager.POOLS.get( key )
+        if pool is not None and not pool.connected:
+          del ConnectionManager.POOLS[ key ]
+          uri.setPassword( "" )
+      finally:
+        ConnectionManager.POOLS_LOCK.release()
+      raise
+
+  @classmethod
+  def acquireConnection(self, conntype, name, parent=None):
+    """ return a connection from the pool, None if the user cancelled """
+    pool = self.getPool( conntype, name, parent )
+    if pool is None:
+      return None
+    return pool.acquire()
+
+  @classmethod
+  def releaseConnection(self, conn):
+    """ give back a connection returned by acquireConnection() """
+    pool = getattr(conn, 'pool', None)
+    if pool is not None:
+      pool.release( conn )
+    else:
+      conn.close()
+
+  @classmethod
+  def closeAllPools(self):
+    ConnectionManager.POOLS_LOCK.acquire()
+    try:
+      pools = ConnectionManager.POOLS.values()
+      ConnectionManager.POOLS = {}
+    finally:
+      ConnectionManager.POOLS_LOCK.release()
+
+    for pool in pools:
+      pool.close()
+
+
+class ConnectionRegistry(QObject):
+  """ the saved connections, as ConnectionAction objects kept between calls.
+
+  update() reads the connection names from the settings and only creates or
+  drops the actions of the connections added or removed since the last time.
+  It runs by itself when the settings file changes; connectionsChanged(
+  PyQt_PyObject, PyQt_PyObject) is emitted with the added and removed actions.
+  """
+
+  def __init__(self, parent=None):
+    QObject.__init__(self, parent)
+    self.actions = OrderedDict()  # (conntype, name) -> ConnectionAction, as in the settings
+
+    self.watcher = QFileSystemWatcher(self)
+    QObject.connect(self.watcher, SIGNAL("fileChanged(const QString &)"), self.settingsChanged)
+    self.watchSettings()
+    self.update()
+
+  def watchSettings(self):
+    # on Windows the settings are in the registry, there is no file to watch
+    path = QSettings().fileName()
+    if os.path.exists( unicode(path) ) and path not in self.watcher.files():
+      self.watcher.addPath( path )
+
+  def settingsChanged(self, path):
+    # the file is usually replaced by a new one, watch it again
+    self.watchSettings()
+    self.update( True )
+
+  def connections(self):
+    return self.actions.values()
+
+  def update(self, sync=False):
+    """ read the saved connections again, sync=True also reads what other
+        processes saved. Returns whether something changed. """
+    settings = QSettings()
+    if sync:
+      settings.sync()
+
+    keys = []
+    for c in ConnectionManager.SUPPORTED_CONNECTORS:
+      settings.beginGroup( "/%s/connections" % ConnectionManager.getSettingsKey(c) )
+      keys.extend( (c, unicode(name)) for name in settings.childGroups() )
+      settings.endGroup()
+
+    actions = OrderedDict()
+    added = []
+    for key in keys:
+      action = self.actions.get( key )
+      if action is None:
+        action = Connection.ConnectionAction( key[1], key[0] )
+        added.append( action )
+      actions[ key ] = action
+    removed = [ a for key, a in self.actions.items() if key not in actions ]
+    self.actions = actions
+
+    if not added and not removed:
+      return False
+    self.emit( SIGNAL("connectionsChanged(PyQt_PyObject, PyQt_PyObject)"), added, removed )
+    return True
+
+
+class ConnectionPool:
+  """ keeps open connections to one database so that they can be reused.
+
+  A connection is checked with is_alive() before being handed out, connections
+  idle for more than 'idle_timeout' seconds are closed (keeping 'minsize' of them)
+  and no more than 'maxsize' connections are open at the same time.
+  """
+
+  def __init__(self, factory, minsize=1, maxsize=4, idle_timeout=300):
+    self.factory = factory
+    self.setOptions(minsize, maxsize, idle_timeout)
+
+    # (conntype, connection name, uri) when created by ConnectionManager
+    self.key = None
+    # whether a connection was ever opened
+    self.connected = False
+    # the catalog cache of the first connection, shared by the others:
+    # a schema change made on one of them empties it for all of them
+    self.catalog_cache = None
+
+    self.idle = []  # (connection, release time), the oldest first
+    self.busy = 0
+    self.cond = threading.Condition()
+
+  def setOptions(self, minsize, maxsize, idle_timeout):
+    self.minsize = max(0, minsize)
+    self.maxsize = max(1, maxsize, self.minsize)
+    self.idle_timeout = idle_timeout
+
+  def acquire(self, timeout=30):
+    """ return a connection, waits up to 'timeout' seconds when all of them are busy """
+    deadline = time.time() + timeout
+    while True:
+      self.cond.acquire()
+      try:
+        self._evictIdle()
+        while not self.idle and self.busy >= self.maxsize:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise DbError( u"no free connection after %d seconds" % timeout )
+          self.cond.wait( remaining )
+
+        # the most recently used connection is the most likely to be alive
+        self.busy += 1
+        conn = self.idle.pop()[0] if self.idle else None
+      finally:
+        self.cond.release()
+
+      if conn is None:
+        break
+
+      # the health check needs a round trip, don't hold the lock meanwhile
+      if conn.is_alive():
+        return conn
+      conn.close()
+      self._giveBackSlot()
+
+    # open a new connection
+    try:
+      conn = self.factory()
+    except:
+      self._giveBackSlot()
+      raise
+    self.connected = True
+    conn.pool = self
+    self.cond.acquire()
+    try:
+      if self.catalog_cache is None:
+        self.catalog_cache = conn.catalog_cache
+      conn.catalog_cache = self.catalog_cache
+    finally:
+      self.cond.release()
+    return conn
+
+  def release(self, conn):
+    """ put back a connection returned by acquire() """
+    try:
+      conn.reset()
+      alive = True
+    except Exception:
+      alive = False
+
+    self.cond.acquire()
+    try:
+      self.busy -= 1
+      if alive:
+        self.idle.append( (conn, time.time()) )
+      self._evictIdle()
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+    if not alive:
+      conn.close()
+
+  def close(self):
+    """ close the idle connections, the busy ones get closed when released """
+    self.cond.acquire()
+    try:
+      idle = self.idle
+      self.idle = []
+      self.minsize = 0
+      self.idle_timeout = 0
+    finally:
+      self.cond.release()
+
+    for conn, released in idle:
+      conn.close()
+
+  def _giveBackSlot(self):
+    self.cond.acquire()
+    try:
+      self.busy -= 1
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def _evictIdle(self):
+    now = time.time()
+    while self.idle and len(self.idle) + self.busy > self.minsize:
+      conn, released = self.idle[0]
+      if now - released < self.idle_timeout:
+        break
+      del self.idle[0]
+      conn.close()
+
+
+class CatalogCache:
+  """ keeps the results of catalog queries for 'ttl' seconds.
+
+  At most 'maxsize' entries are kept, the least recently used ones are
+  dropped first. hits and misses count the lookups.
+  """
+
+  def __init__(self, ttl=60, maxsize=256):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.entries = OrderedDict()  # key -> (store time, value), the least recently used first
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """ returns a tuple (found, value) """
+    self.lock.acquire()
+    try:
+      entry = self.entries.pop(key, None)
+      if entry is None or time.time() - entry[0] > self.ttl:
+        self.misses += 1
+        return False, None
+      # move it to the end, it's the most recently used now
+      self.entries[key] = entry
+      self.hits += 1
+      return True, entry[1]
+    finally:
+      self.lock.release()
+
+  def put(self, key, value):
+    self.lock.acquire()
+    try:
+      self.entries.pop(key, None)
+      self.entries[key] = (time.time(), value)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+    finally:
+      self.lock.release()
+
+  def invalidate(self):
+    self.lock.acquire()
+    try:
+      self.entries.clear()
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    """ returns a tuple (hits, misses, entries) """
+    return self.hits, self.misses, len(self.entries)
+
+
+def cached_catalog(method):
+  """ decorator for the Connection methods reading the catalog, their results are
+      kept in the connection's catalog cache. Don't modify the returned values. """
+  @wraps(method)
+  def wrapper(self, *args, **kwargs):
+    # lists can't be dict keys, use tuples instead
+    freeze = lambda x: tuple(x) if isinstance(x, list) else x
+    key = (method.__name__, tuple(map(freeze, args)), tuple(sorted( [(k, freeze(v)) for k, v in kwargs.items()] )))
+    found, value = self.catalog_cache.get(key)
+    if not found:
+      value = method(self, *args, **kwargs)
+      self.catalog_cache.put(key, value)
+    return value
+  return wrapper
+
+def invalidates_catalog(method):
+  """ decorator for the Connection methods changing the schema, they empty the catalog
+      cache (the one of the pool, shared by its connections) """
+  @wraps(method)
+  def wrapper(self, *args, **kwargs):
+    try:
+      return method(self, *args, **kwargs)
+    finally:
+      self.catalog_cache.invalidate()
+  return wrapper
 
 
 class NotSupportedConnTypeException(Exception):
@@ -62,6 +495,8 @@ class DbError(Exception):
   def __init__(self, errormsg, query=None):
     self.msg = unicode( errormsg )
     self.query = unicode( query ) if query else None
+    # the code given by the driver (SQLSTATE for PostgreSQL), if any
+    self.code = None
 
   def __str__(self):
     msg = self.msg.encode('utf-8')
@@ -72,8 +507,16 @@ class DbError(Exception):
 
 class Connection:
 
+  # options of the catalog cache
+  CATALOG_CACHE_TTL = 60  # seconds
+  CATALOG_CACHE_SIZE = 256
+
+  # preferred names of the unique column of a layer, see pick_layer_columns
+  KEY_NAMES = ('gid', 'id', 'fid', 'ogc_fid', 'objectid', 'pk')
+
   def __init__(self, uri):
     self.uri = uri
+    self.catalog_cache = CatalogCache(self.CATALOG_CACHE_TTL, self.CATALOG_CACHE_SIZE)
 
   @classmethod
   def getTypeName(self):
@@ -95,6 +538,21 @@ class Connection:
   def icon(self):
     pass
 
+  @classmethod
+  def getSettingsURI(self, selected):
+    """ returns a QgsDataSourceURI built from the stored settings of a connection """
+    pass
+
+  @classmethod
+  def isPasswordSaved(self, selected):
+    """ whether connecting doesn't need to ask for the password """
+    return True
+
+  @classmethod
+  def requestPassword(self, selected, uri, parent=None):
+    """ asks for the password if it's not stored, returns False if cancelled """
+    return True
+
   @classmethod
   def getAvailableConnections(self):
     connections = []
@@ -116,31 +574,145 @@ class Connection:
   def getAction(self, parent=None):
     return Connection.ConnectionAction(self.uri.database(), self.getTypeName(), parent)
 
+  def is_alive(self):
+    """ check whether the connection is still usable """
+    try:
+      c = self.con.cursor()
+      c.execute("SELECT 1")
+      c.fetchone()
+      self.con.rollback()
+      return True
+    except Exception:
+      return False
+
+  def reset(self):
+    """ leave the connection in a clean state before it gets reused """
+    self.con.rollback()
+
+  def cancel(self):
+    """ abort the query running on this connection, can be called from another thread """
+    pass
+
+  def check_query(self, query):
+    """ run a query (fetching one row at most) to find out whether it works """
+    c = self.con.cursor()
+    self._exec_sql(c, u"SELECT * FROM (%s\n) AS subquery LIMIT 1" % query)
+    c.fetchall()
+
+  def get_query_columns(self, query):
+    """ (name, kind) of the columns of a query's result, kind is 'geometry', 'integer' or None """
+    pass
+
+  def pick_layer_columns(self, columns, geom=None, key=None):
+    """ choose the geometry and unique columns of a layer among the columns
+        returned by get_query_columns(). geom is kept if it's a geometry
+        column, or a column of an unknown kind when no geometry column is
+        found. key is kept if it's a column of the result, otherwise the
+        first of KEY_NAMES which is an integer (or unknown) column is used:
+        any other integer column may have duplicates. Returns (geometry
+        column, unique column), None for the ones which can't be found, a
+        layer without unique column gets its ids from the provider """
+    kinds = dict(columns)
+    if kinds.get(geom) != 'geometry':
+      geoms = [name for name, kind in columns if kind == 'geometry']
+      if geoms:
+        geom = geoms[0]
+      elif geom not in kinds:
+        geom = None
+
+    if key not in kinds:
+      keys = [name for name in self.KEY_NAMES if kinds.get(name, 'geometry') in ('integer', None)]
+      key = keys[0] if keys else None
+    return geom, key
+
+  def explain(self, query, analyze=False):
+    """ the plan of a query, the root PlanNode. with analyze the query is
+        run and the nodes get their actual time and rows """
+    pass
+
+  def flag_geometry_scans(self, root, tables):
+    """ flag the sequential scans of a plan on tables (lower case names)
+        with a geometry column: their spatial index isn't used """
+    for node in root.walk():
+      node.geometry_scan = node.seq_scan and node.relation is not None and node.relation.lower() in tables
+    return root
+
+  def close(self):
+    try:
+      self.con.close()
+    except Exception:
+      pass
+
 
   class ConnectionAction(QAction):
     def __init__(self, text, conntype, parent=None):
       self.type = conntype
-      icon = ConnectionManager.getConnection(self.type).icon()
+      icon = ConnectionManager.icon(self.type)
       QAction.__init__(self, icon, text, parent)
 
     def connect(self):
+      """ returns a pooled connection, give it back using ConnectionManager.releaseConnection() """
+      pool = self.getPool()
+      if pool is None:
+        return
+      return pool.acquire()
+
+    def getPool(self):
+      """ returns the connection pool, None if the user cancelled """
       selected = self.text()
-      conn = ConnectionManager.getConnection( self.type ).connect( selected, self.parent() )
+      pool = ConnectionManager.getPool( self.type, selected, self.parent() )
+      if pool is None:
+        return
 
       # set as default in QSettings
       settings = QSettings()
-      settings.setValue( "/%s/connections/selected" % conn.getSettingsKey(), selected )
+      settings.setValue( "/%s/connections/selected" % ConnectionManager.getSettingsKey( self.type ), selected )
 
-      return conn
+      return pool
       
     def getTypeName(self):
     
       return self.type
 
 
+class TableDescription:
+  """ everything known about a table, as returned by the describe methods of the connections """
+
+  def __init__(self, name, schema=None):
+    self.name = name
+    self.schema = schema
+    self.fields = []
+    self.indexes = []
+    self.constraints = []
+    self.triggers = []
+    self.rules = []
+    self.privileges = None
+
 class TableAttribute:
   pass
 
+class PlanNode:
+  """ a node of a query plan, see Connection.explain(). cost and rows are
+      the planner estimates, actual_time (ms) and actual_rows the measures
+      of EXPLAIN ANALYZE, None when they aren't known """
+
+  def __init__(self, name, relation=None, detail=None):
+    self.name = name
+    self.relation = relation
+    self.detail = detail
+    self.cost = self.rows = None
+    self.actual_time = self.actual_rows = self.loops = None
+    self.seq_scan = False
+    self.geometry_scan = False
+    self.children = []
+
+  def walk(self):
+    """ this node and the ones below it """
+    yield self
+    for child in self.children:
+      for node in child.walk():
+        yield node
+
 class TableConstraint:
   """ class that represents a constraint of a table (relation) """
   
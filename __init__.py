@@ -21,6 +21,9 @@
 """
 
 def classFactory(iface):
-    # load PostgisLayer class from file PostgisLayer
-    from postgislayer import PostgisLayer
+    # load PostgisLayer class from file PostgisLayer,
+    # it's kept light: the rest is imported when first used
+    import timings
+    with timings.timed("import postgislayer"):
+        from postgislayer import PostgisLayer
     return PostgisLayer(iface)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Benchmarks the query editor highlighting (Highlighter and QFormatter)
+on synthetic SQL documents from 1 KB to 5 MB:
+
+    python benchmarks/bench_highlighter.py -o results.json
+
+Each document size runs in its own process, so the peak memory reported
+is the one of that size only. PyQt4 needs a display, on a headless
+machine run it under Xvfb:
+
+    xvfb-run python benchmarks/bench_highlighter.py
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+from optparse import OptionParser
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PLUGIN_DIR)
+
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024]
+
+STATEMENT = """-- statement %(n)d
+SELECT p.gid, p.owner_%(n)d, ST_Area(p.geom) / 10000.0 AS ha,
+       ST_Transform(ST_Buffer(p.geom, %(n)d), 4326) AS geom
+  FROM cadastre.parcels p
+  JOIN roads r ON ST_DWithin(p.geom, r.geom, 50) /* uses the
+  spatial index */
+ WHERE r.kind = 'highway %(n)d' AND p."Owner Name" <> 'it''s'
+ ORDER BY ha DESC LIMIT %(n)d;
+CREATE FUNCTION f_%(n)d() RETURNS int AS $$ SELECT %(n)d $$ LANGUAGE sql;
+"""
+
+PASTE = STATEMENT % {'n': 0} * 20
+
+
+def synthetic_sql(size):
+    """ SQL statements adding up to size characters """
+    parts = []
+    length = n = 0
+    while length < size:
+        part = STATEMENT % {'n': n}
+        parts.append(part)
+        length += len(part)
+        n += 1
+    return ''.join(parts)[:size]
+
+
+def peak_memory():
+    """ peak resident memory of this process, in KB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def finish(highlighter):
+    """ highlight the blocks deferred on large documents, as the timer would """
+    while highlighter.pendingFrom is not None:
+        highlighter.highlightPending()
+
+
+def measure(size, engine):
+    from PyQt4 import QtGui
+    import highlighter as hl
+
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+    text = synthetic_sql(size)
+    doc = QtGui.QTextDocument()
+    highlighter = hl.Highlighter(doc, 'sql', engine)
+    result = {'size': size, 'engine': engine, 'blocks': text.count('\n') + 1}
+
+    # initial highlight: what is done before the editor shows up,
+    # then everything
+    started = time.time()
+    doc.setPlainText(text)
+    result['initial'] = time.time() - started
+    finish(highlighter)
+    result['initial_complete'] = time.time() - started
+
+    # a keystroke in the middle of the document
+    cursor = QtGui.QTextCursor(doc)
+    cursor.setPosition(len(text) // 2)
+    started = time.time()
+    cursor.insertText('x')
+    result['keystroke'] = time.time() - started
+
+    # a keystroke opening a comment, everything after it changes
+    started = time.time()
+    cursor.insertText('/*')
+    result['open_comment'] = time.time() - started
+    finish(highlighter)
+    result['open_comment_complete'] = time.time() - started
+
+    # pasting a few statements
+    started = time.time()
+    cursor.insertText(PASTE)
+    result['paste'] = time.time() - started
+    finish(highlighter)
+    result['paste_complete'] = time.time() - started
+
+    result['peak_memory_kb'] = peak_memory()
+    return result
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-o', '--output', default='bench_highlighter.json',
+                      help="file the results are written to (JSON)")
+    parser.add_option('-e', '--engine', action='append', dest='engines',
+                      help="fast or pygments, may be repeated (default: both)")
+    parser.add_option('-s', '--size', type='int', action='append', dest='sizes',
+                      help="document size in bytes, may be repeated")
+    parser.add_option('--child', action='store_true', help=OptionParser.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    engines = options.engines or ['fast', 'pygments']
+    sizes = options.sizes or SIZES
+
+    if options.child:
+        # a single measure, for the parent process
+        json.dump(measure(sizes[0], engines[0]), sys.stdout)
+        return
+
+    results = []
+    for engine in engines:
+        for size in sizes:
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                           '--child', '-e', engine, '-s', str(size)])
+            result = json.loads(out)
+            results.append(result)
+            sys.stderr.write("%(engine)-8s %(size)8d B  initial %(initial)7.3f s "
+                             "(complete %(initial_complete)7.3f s)  keystroke %(keystroke)6.4f s  "
+                             "paste %(paste)6.4f s  peak %(peak_memory_kb)d KB\n" % result)
+
+    f = open(options.output, 'w')
+    try:
+        json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'results': results}, f, indent=2)
+    finally:
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
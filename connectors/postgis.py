@@ -26,7 +26,10 @@ import psycopg2.extensions # for isolation levels
 
 from .. import DbConnection as DbConn
 
+import json
 import re
+import time
+from cStringIO import StringIO
 
 # use unicode!
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
@@ -70,6 +73,17 @@ class TableRule(DbConn.TableRule):
 		self.name, self.definition = row
 
 
+class PlanNode(DbConn.PlanNode):
+	def __init__(self, plan):
+		""" plan is a node of EXPLAIN (FORMAT JSON) """
+		detail = plan.get('Index Name') or plan.get('Filter') or plan.get('Hash Cond') or plan.get('Join Filter')
+		DbConn.PlanNode.__init__(self, plan['Node Type'], plan.get('Relation Name'), detail)
+		self.cost, self.rows = plan.get('Total Cost'), plan.get('Plan Rows')
+		self.actual_time, self.actual_rows, self.loops = plan.get('Actual Total Time'), plan.get('Actual Rows'), plan.get('Actual Loops')
+		self.seq_scan = self.name == 'Seq Scan'
+		self.children = [PlanNode(p) for p in plan.get('Plans', [])]
+
+
 class DbError(DbConn.DbError):
 	def __init__(self, error, query=None):
 		# save error. funny that the variables are in utf8, not 
@@ -80,6 +94,7 @@ class DbError(DbConn.DbError):
 		else:
 			query = unicode(query)
 		DbConn.DbError.__init__(self, msg, query)
+		self.code = getattr(error, "pgcode", None)
 		
 
 class TableField(DbConn.TableField):
@@ -111,6 +126,13 @@ class Connection(DbConn.Connection):
 
 	@classmethod
 	def connect(self, selected, parent=None):
+		uri = self.getSettingsURI(selected)
+		if not self.requestPassword(selected, uri, parent):
+			return
+		return Connection(uri)
+
+	@classmethod
+	def getSettingsURI(self, selected):
 		settings = QSettings()
 		settings.beginGroup( u"/%s/connections/%s" % (self.getSettingsKey(), selected) )
 
@@ -120,16 +142,28 @@ class Connection(DbConn.Connection):
 		get_value_str = lambda x: unicode(settings.value(x))
 		host, port, database, username, password = map(get_value_str, ["host", "port", "database", "username", "password"])
 
-		# qgis1.5 use 'savePassword' instead of 'save' setting
-		if not ( settings.value("save") or settings.value("savePassword") ):
-			(password, ok) = QInputDialog.getText(parent, "Enter password", 'Enter password for connection "%s":' % selected, QLineEdit.Password)
-			if not ok: return
-
 		settings.endGroup()
 
 		uri = qgis.core.QgsDataSourceURI()
 		uri.setConnection(host, port, database, username, password)
-		return Connection(uri)
+		return uri
+
+	@classmethod
+	def isPasswordSaved(self, selected):
+		settings = QSettings()
+		settings.beginGroup( u"/%s/connections/%s" % (self.getSettingsKey(), selected) )
+		# qgis1.5 use 'savePassword' instead of 'save' setting
+		saved = settings.value("save") or settings.value("savePassword")
+		settings.endGroup()
+		return bool(saved)
+
+	@classmethod
+	def requestPassword(self, selected, uri, parent=None):
+		if not self.isPasswordSaved(selected):
+			(password, ok) = QInputDialog.getText(parent, "Enter password", 'Enter password for connection "%s":' % selected, QLineEdit.Password)
+			if not ok: return False
+			uri.setPassword(password)
+		return True
 
 	
 	def __init__(self, uri):
@@ -148,6 +182,9 @@ class Connection(DbConn.Connection):
 			self.con = psycopg2.connect(self.con_info())
 		except psycopg2.OperationalError, e:
 			raise DbError(e)
+
+		# names of the statements prepared on this connection, see _exec_prepared
+		self.prepared = {}
 		
 		self.has_spatial = self.check_spatial()
 
@@ -165,6 +202,13 @@ class Connection(DbConn.Connection):
 		if self.passwd: con_str += "password='%s' " % self.passwd
 		return con_str
 
+	def cancel(self):
+		""" ask the server to abort the running query """
+		try:
+			self.con.cancel()
+		except psycopg2.Error, e:
+			pass
+
 	def get_info(self):
 		c = self.con.cursor()
 		self._exec_sql(c, "SELECT version()")
@@ -191,18 +235,17 @@ class Connection(DbConn.Connection):
 		
 	def check_geometry_columns_table(self):
 
+		# find out in the same query whether has privileges to access geometry_columns table
 		c = self.con.cursor()
-		self._exec_sql(c, "SELECT relname FROM pg_class WHERE relname = 'geometry_columns' AND pg_class.relkind IN ('v', 'r')")
-		self.has_geometry_columns = (len(c.fetchall()) != 0)
-		
-		if not self.has_geometry_columns:
-			self.has_geometry_columns_access = False
-			return
-			
-		# find out whether has privileges to access geometry_columns table
-		self.has_geometry_columns_access = self.get_table_privileges('geometry_columns')[0]
+		self._exec_sql(c, """SELECT has_table_privilege(oid, 'SELECT') FROM pg_class
+						WHERE relname = 'geometry_columns' AND pg_class.relkind IN ('v', 'r')
+						ORDER BY pg_table_is_visible(oid) DESC LIMIT 1""")
+		row = c.fetchone()
+		self.has_geometry_columns = row is not None
+		self.has_geometry_columns_access = self.has_geometry_columns and row[0]
 
 
+	@DbConn.cached_catalog
 	def list_schemas(self):
 		"""
 			get list of schemas in tuples: (oid, name, owner, perms)
@@ -215,6 +258,7 @@ class Connection(DbConn.Connection):
 		
 		return sorted(c.fetchall(), cmp=schema_cmp)
 			
+	@DbConn.cached_catalog
 	def list_geotables(self, schema=None):
 		"""
 			get list of tables with schemas, whether user has privileges, whether table has geometry column(s) etc.
@@ -228,9 +272,19 @@ class Connection(DbConn.Connection):
 			- type
 		"""
 		c = self.con.cursor()
-		
+		self._exec_sql(c, self._geotables_sql(schema), { 'schema' : schema })
+		return c.fetchall()
+
+	def iter_geotables(self, schema=None, batch_size=1000):
+		""" like list_geotables, but yields the tables in lists of batch_size rows
+		 read from a server-side cursor. useful for databases with many relations """
+		return self.iter_query(self._geotables_sql(schema), batch_size, { 'schema' : schema })
+
+	def _geotables_sql(self, schema):
+		""" one query returning the tables with their geometry columns, including
+		 type, dimension and srid from geometry_columns when it's readable """
 		if schema:
-			schema_where = " AND nspname = '%s' " % self._quote_str(schema)
+			schema_where = " AND nspname = %(schema)s "
 		else:
 			schema_where = " AND (nspname != 'information_schema' AND nspname !~ 'pg_') "
 			
@@ -239,39 +293,28 @@ class Connection(DbConn.Connection):
 		# first find out whether postgis is enabled
 		if not self.has_spatial:
 			# get all tables and views
-			sql = """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, NULL, NULL, NULL, NULL
+			return """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, NULL, NULL, NULL, NULL
 							FROM pg_class
 							JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
 							WHERE pg_class.relkind IN ('v', 'r')""" + schema_where + "ORDER BY nspname, relname"
+
+		if self.has_geometry_columns and self.has_geometry_columns_access:
+			geo_columns = "COALESCE(geometry_columns.type, pg_attribute.atttypid::regtype::text), geometry_columns.coord_dimension, geometry_columns.srid"
+			geo_join = """LEFT OUTER JOIN geometry_columns ON f_table_schema = nspname AND f_table_name = relname
+									AND f_geometry_column = attname"""
 		else:
-			# discovery of all tables and whether they contain a geometry column
-			sql = """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, pg_attribute.attname, pg_attribute.atttypid::regtype, NULL, NULL
-							FROM pg_class
-							JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
-							LEFT OUTER JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND
-									( pg_attribute.atttypid = 'geometry'::regtype
-										OR pg_attribute.atttypid IN (SELECT oid FROM pg_type WHERE typbasetype='geometry'::regtype ) )
-							WHERE pg_class.relkind IN ('v', 'r')""" + schema_where + "ORDER BY nspname, relname, attname"
-						  
-		self._exec_sql(c, sql)
-		items = c.fetchall()
-		
-		# get geometry info from geometry_columns if exists
-		if self.has_spatial and self.has_geometry_columns and self.has_geometry_columns_access:
-			sql = """SELECT relname, nspname, relkind, pg_get_userbyid(relowner), reltuples, relpages,
-							geometry_columns.f_geometry_column, geometry_columns.type, geometry_columns.coord_dimension, geometry_columns.srid
-							FROM pg_class
-						  JOIN pg_namespace ON relnamespace=pg_namespace.oid
-						  LEFT OUTER JOIN geometry_columns ON relname=f_table_name AND nspname=f_table_schema
-						  WHERE (relkind = 'r' or relkind='v') """ + schema_where + "ORDER BY nspname, relname, f_geometry_column"
-			self._exec_sql(c, sql)
-			
-			# merge geometry info to "items"
-			for i, geo_item in enumerate(c.fetchall()):
-				if geo_item[7]:
-					items[i] = geo_item
-			
-		return items
+			geo_columns = "pg_attribute.atttypid::regtype, NULL, NULL"
+			geo_join = ""
+
+		# discovery of all tables, their geometry columns and (if available) their type, dimension and srid
+		return """SELECT pg_class.relname, pg_namespace.nspname, pg_class.relkind, pg_get_userbyid(relowner), reltuples, relpages, pg_attribute.attname, """ + geo_columns + """
+						FROM pg_class
+						JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+						LEFT OUTER JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid AND
+								( pg_attribute.atttypid = 'geometry'::regtype
+									OR pg_attribute.atttypid IN (SELECT oid FROM pg_type WHERE typbasetype='geometry'::regtype ) )
+						""" + geo_join + """
+						WHERE pg_class.relkind IN ('v', 'r')""" + schema_where + "ORDER BY nspname, relname, attname"
 	
 	
 	def get_table_rows(self, table, schema=None):
@@ -280,10 +323,10 @@ class Connection(DbConn.Connection):
 		return c.fetchone()[0]
 		
 		
+	@DbConn.cached_catalog
 	def get_table_fields(self, table, schema=None):
 		""" return list of columns in table """
 		c = self.con.cursor()
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT a.attnum AS ordinal_position,
 				a.attname AS column_name,
 				t.typname AS data_type,
@@ -291,70 +334,70 @@ class Connection(DbConn.Connection):
 				a.atttypmod AS modifier,
 				a.attnotnull AS notnull,
 				a.atthasdef AS hasdefault,
-				adef.adsrc AS default_value
+				pg_get_expr(adef.adbin, adef.adrelid) AS default_value
 			FROM pg_class c
 			JOIN pg_attribute a ON a.attrelid = c.oid
 			JOIN pg_type t ON a.atttypid = t.oid
 			JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
 			LEFT JOIN pg_attrdef adef ON adef.adrelid = a.attrelid AND adef.adnum = a.attnum
 			WHERE
-			  c.relname = '%s' %s AND
+			  c.relname = $1 AND ($2 IS NULL OR nspname = $2) AND
 				a.attnum > 0
-			ORDER BY a.attnum""" % (self._quote_str(table), schema_where)
+			ORDER BY a.attnum"""
 
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "table_fields", sql, (table, schema), ("text", "text"))
 		attrs = []
 		for row in c.fetchall():
 			attrs.append(TableAttribute(row))
 		return attrs
 		
 		
+	@DbConn.cached_catalog
 	def get_table_indexes(self, table, schema=None):
 		""" get info about table's indexes. ignore primary key and unique constraint index, they get listed in constaints """
 		c = self.con.cursor()
 		
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT relname, indkey FROM pg_class, pg_index
 						 WHERE pg_class.oid = pg_index.indexrelid AND pg_class.oid IN (
 						         SELECT indexrelid FROM pg_index, pg_class
 										 JOIN pg_namespace nsp ON pg_class.relnamespace = nsp.oid
-										 WHERE pg_class.relname='%s' %s AND pg_class.oid=pg_index.indrelid
-										 AND indisprimary != 't' )""" % (self._quote_str(table), schema_where) # AND indisunique != 't' 
-		self._exec_sql(c, sql)
+										 WHERE pg_class.relname = $1 AND ($2 IS NULL OR nspname = $2) AND pg_class.oid=pg_index.indrelid
+										 AND indisprimary != 't' )""" # AND indisunique != 't' 
+		self._exec_prepared(c, "table_indexes", sql, (table, schema), ("text", "text"))
 		indexes = []
 		for row in c.fetchall():
 			indexes.append(TableIndex(row))
 		return indexes
 
 
+	@DbConn.cached_catalog
 	def get_table_unique_indexes(self, table, schema=None):
 		""" get all the unique indexes """
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT relname, indkey 
 						FROM pg_index JOIN pg_class ON pg_index.indrelid=pg_class.oid 
 						JOIN pg_namespace nsp ON pg_class.relnamespace = nsp.oid 
-							WHERE pg_class.relname='%s' %s 
-							AND indisprimary != 't' AND indisunique = 't'""" % (self._quote_str(table), schema_where)
+							WHERE pg_class.relname = $1 AND ($2 IS NULL OR nspname = $2) 
+							AND indisprimary != 't' AND indisunique = 't'"""
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "table_unique_indexes", sql, (table, schema), ("text", "text"))
 		uniqueIndexes = []
 		for row in c.fetchall():
 			uniqueIndexes.append(TableIndex(row))
 		return uniqueIndexes
 	
 	
+	@DbConn.cached_catalog
 	def get_table_constraints(self, table, schema=None):
 		c = self.con.cursor()
 		
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
-		sql = """SELECT c.conname, c.contype, c.condeferrable, c.condeferred, array_to_string(c.conkey, ' '), c.consrc,
+		sql = """SELECT c.conname, c.contype, c.condeferrable, c.condeferred, array_to_string(c.conkey, ' '), pg_get_expr(c.conbin, c.conrelid),
 		         t2.relname, c.confupdtype, c.confdeltype, c.confmatchtype, array_to_string(c.confkey, ' ') FROM pg_constraint c
 		  LEFT JOIN pg_class t ON c.conrelid = t.oid
 			LEFT JOIN pg_class t2 ON c.confrelid = t2.oid
 			JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
-			WHERE t.relname = '%s' %s """ % (self._quote_str(table), schema_where)
+			WHERE t.relname = $1 AND ($2 IS NULL OR nspname = $2) """
 		
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "table_constraints", sql, (table, schema), ("text", "text"))
 		
 		constrs = []
 		for row in c.fetchall():
@@ -362,17 +405,17 @@ class Connection(DbConn.Connection):
 		return constrs
 
 
+	@DbConn.cached_catalog
 	def get_table_triggers(self, table, schema=None):
 		c = self.con.cursor()
 		
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """ SELECT tgname, proname, tgtype, tgenabled FROM pg_trigger trig
 		          LEFT JOIN pg_class t ON trig.tgrelid = t.oid
 							LEFT JOIN pg_proc p ON trig.tgfoid = p.oid
 							JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
-							WHERE t.relname ='%s' %s """ % (self._quote_str(table), schema_where)
+							WHERE t.relname = $1 AND ($2 IS NULL OR nspname = $2) """
 	
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "table_triggers", sql, (table, schema), ("text", "text"))
 
 		triggers = []
 		for row in c.fetchall():
@@ -380,14 +423,14 @@ class Connection(DbConn.Connection):
 		return triggers
 		
 	
+	@DbConn.cached_catalog
 	def get_table_rules(self, table, schema=None):
 		c = self.con.cursor()
 		
-		schema_where = " AND schemaname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """ SELECT rulename, definition FROM pg_rules
-					WHERE tablename='%s' %s """ % (self._quote_str(table), schema_where)
+					WHERE tablename = $1 AND ($2 IS NULL OR schemaname = $2) """
 	
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "table_rules", sql, (table, schema), ("text", "text"))
 
 		rules = []
 		for row in c.fetchall():
@@ -395,25 +438,98 @@ class Connection(DbConn.Connection):
 
 		return rules
 
+	@DbConn.cached_catalog
+	def describe_tables(self, schema, tables=None):
+		""" returns a dict: table name -> TableDescription with fields, indexes, constraints,
+		 triggers, rules and privileges of the tables (all of them if tables is None) in a schema.
+		 it runs one query per kind of information, whatever the number of tables """
+		if tables is not None:
+			tables = list(tables)
+			if not tables:
+				return {}
+
+		c = self.con.cursor()
+		params = (schema, tables)
+		types = ("text", "text[]")
+		descs = {}
+		def desc(name):
+			if name not in descs:
+				descs[name] = DbConn.TableDescription(name, schema)
+			return descs[name]
+
+		sql = """SELECT c.relname, a.attnum, a.attname, t.typname, a.attlen, a.atttypmod,
+				a.attnotnull, a.atthasdef, pg_get_expr(adef.adbin, adef.adrelid)
+			FROM pg_class c
+			JOIN pg_attribute a ON a.attrelid = c.oid
+			JOIN pg_type t ON a.atttypid = t.oid
+			JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+			LEFT JOIN pg_attrdef adef ON adef.adrelid = a.attrelid AND adef.adnum = a.attnum
+			WHERE nspname = $1 AND ($2 IS NULL OR c.relname = ANY($2)) AND
+				c.relkind IN ('v', 'r') AND a.attnum > 0
+			ORDER BY c.relname, a.attnum"""
+		self._exec_prepared(c, "describe_fields", sql, params, types)
+		for row in c.fetchall():
+			desc(row[0]).fields.append( TableAttribute(row[1:]) )
+
+		sql = """SELECT t.relname, i.relname, x.indkey FROM pg_index x
+			JOIN pg_class i ON i.oid = x.indexrelid
+			JOIN pg_class t ON t.oid = x.indrelid
+			JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
+			WHERE nspname = $1 AND ($2 IS NULL OR t.relname = ANY($2)) AND indisprimary != 't'"""
+		self._exec_prepared(c, "describe_indexes", sql, params, types)
+		for row in c.fetchall():
+			desc(row[0]).indexes.append( TableIndex(row[1:]) )
+
+		sql = """SELECT t.relname, c.conname, c.contype, c.condeferrable, c.condeferred, array_to_string(c.conkey, ' '), pg_get_expr(c.conbin, c.conrelid),
+			t2.relname, c.confupdtype, c.confdeltype, c.confmatchtype, array_to_string(c.confkey, ' ') FROM pg_constraint c
+			JOIN pg_class t ON c.conrelid = t.oid
+			LEFT JOIN pg_class t2 ON c.confrelid = t2.oid
+			JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
+			WHERE nspname = $1 AND ($2 IS NULL OR t.relname = ANY($2))"""
+		self._exec_prepared(c, "describe_constraints", sql, params, types)
+		for row in c.fetchall():
+			desc(row[0]).constraints.append( TableConstraint(row[1:]) )
+
+		sql = """SELECT t.relname, tgname, proname, tgtype, tgenabled FROM pg_trigger trig
+			JOIN pg_class t ON trig.tgrelid = t.oid
+			LEFT JOIN pg_proc p ON trig.tgfoid = p.oid
+			JOIN pg_namespace nsp ON t.relnamespace = nsp.oid
+			WHERE nspname = $1 AND ($2 IS NULL OR t.relname = ANY($2))"""
+		self._exec_prepared(c, "describe_triggers", sql, params, types)
+		for row in c.fetchall():
+			desc(row[0]).triggers.append( TableTrigger(row[1:]) )
+
+		sql = """SELECT tablename, rulename, definition FROM pg_rules
+			WHERE schemaname = $1 AND ($2 IS NULL OR tablename = ANY($2))"""
+		self._exec_prepared(c, "describe_rules", sql, params, types)
+		for row in c.fetchall():
+			desc(row[0]).rules.append( TableRule(row[1:]) )
+
+		for name, privileges in self.get_tables_privileges(schema).iteritems():
+			if tables is None or name in tables:
+				desc(name).privileges = privileges
+
+		return descs
+
 	def get_table_estimated_extent(self, geom, table, schema=None):
 		""" find out estimated extent (from the statistics) """
 		c = self.con.cursor()
 
-		extent = "estimated_extent('%s','%s','%s')" % (self._quote_str(schema), self._quote_str(table), self._quote_str(geom))
+		extent = "estimated_extent(%(schema)s, %(table)s, %(geom)s)"
 		sql = """ SELECT xmin(%(ext)s), ymin(%(ext)s), xmax(%(ext)s), ymax(%(ext)s) """ % { 'ext' : extent }
-		self._exec_sql(c, sql)
+		self._exec_sql(c, sql, { 'schema' : schema, 'table' : table, 'geom' : geom })
 		
 		row = c.fetchone()
 		return row
 	
+	@DbConn.cached_catalog
 	def get_view_definition(self, view, schema=None):
 		""" returns definition of the view """
-		schema_where = " AND nspname='%s' " % self._quote_str(schema) if schema is not None else ""
 		sql = """SELECT pg_get_viewdef(c.oid) FROM pg_class c
 						JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
-		        WHERE relname='%s' %s AND relkind='v'""" % (self._quote_str(view), schema_where)
+		        WHERE relname = $1 AND ($2 IS NULL OR nspname = $2) AND relkind='v'"""
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "view_definition", sql, (view, schema), ("text", "text"))
 		return c.fetchone()[0]
 		
 	"""
@@ -423,34 +539,35 @@ class Connection(DbConn.Connection):
 		return c.fetchall()
 	"""
 		
+	@DbConn.invalidates_catalog
 	def add_geometry_column(self, table, geom_type, schema=None, geom_column='the_geom', srid=-1, dim=2):
 		
 		# use schema if explicitly specified
+		params = [table, geom_column, srid, geom_type, dim]
 		if schema:
-			schema_part = "'%s', " % self._quote_str(schema)
-		else:
-			schema_part = ""
-		sql = "SELECT AddGeometryColumn(%s'%s', '%s', %d, '%s', %d)" % (schema_part, self._quote_str(table), self._quote_str(geom_column), srid, self._quote_str(geom_type), dim)
-		self._exec_sql_and_commit(sql)
+			params.insert(0, schema)
+		sql = "SELECT AddGeometryColumn(%s)" % ", ".join( ["%s"] * len(params) )
+		self._exec_sql_and_commit(sql, params)
 		
+	@DbConn.invalidates_catalog
 	def delete_geometry_column(self, table, geom_column, schema=None):
 		""" use postgis function to delete geometry column correctly """
+		params = [table, geom_column]
 		if schema:
-			schema_part = "'%s', " % self._quote_str(schema)
-		else:
-			schema_part = ""
-		sql = "SELECT DropGeometryColumn(%s'%s', '%s')" % (schema_part, self._quote_str(table), self._quote_str(geom_column))
-		self._exec_sql_and_commit(sql)
+			params.insert(0, schema)
+		sql = "SELECT DropGeometryColumn(%s)" % ", ".join( ["%s"] * len(params) )
+		self._exec_sql_and_commit(sql, params)
 		
+	@DbConn.invalidates_catalog
 	def delete_geometry_table(self, table, schema=None):
 		""" delete table with one or more geometries using postgis function """
+		params = [table]
 		if schema:
-			schema_part = "'%s', " % self._quote_str(schema)
-		else:
-			schema_part = ""
-		sql = "SELECT DropGeometryTable(%s'%s')" % (schema_part, self._quote_str(table))
-		self._exec_sql_and_commit(sql)
+			params.insert(0, schema)
+		sql = "SELECT DropGeometryTable(%s)" % ", ".join( ["%s"] * len(params) )
+		self._exec_sql_and_commit(sql, params)
 		
+	@DbConn.invalidates_catalog
 	def create_table(self, table, fields, pkey=None, schema=None):
 		""" create ordinary table
 				'fields' is array containing instances of TableField
@@ -471,6 +588,7 @@ class Connection(DbConn.Connection):
 		self._exec_sql_and_commit(sql)
 		return True
 	
+	@DbConn.invalidates_catalog
 	def delete_table(self, table, schema=None):
 		""" delete table from the database """
 		table_name = self._table_name(schema, table)
@@ -483,6 +601,7 @@ class Connection(DbConn.Connection):
 		sql = "TRUNCATE %s" % table_name
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def rename_table(self, table, new_table, schema=None):
 		""" rename a table in database """
 		table_name = self._table_name(schema, table)
@@ -491,16 +610,154 @@ class Connection(DbConn.Connection):
 		
 		# update geometry_columns if postgis is enabled
 		if self.has_spatial and self.has_geometry_columns and self.has_geometry_columns_access:
-			sql = "UPDATE geometry_columns SET f_table_name='%s' WHERE f_table_name='%s'" % (self._quote_str(new_table), self._quote_str(table))
+			sql = "UPDATE geometry_columns SET f_table_name=%s WHERE f_table_name=%s"
+			params = [new_table, table]
 			if schema is not None:
-				sql += " AND f_table_schema='%s'" % self._quote_str(schema)
-			self._exec_sql_and_commit(sql)
+				sql += " AND f_table_schema=%s"
+				params.append(schema)
+			self._exec_sql_and_commit(sql, params)
 		
+	@DbConn.invalidates_catalog
 	def create_view(self, name, query, schema=None):
 		view_name = self._table_name(schema, name)
 		sql = "CREATE VIEW %s AS %s" % (view_name, query)
 		self._exec_sql_and_commit(sql)
 	
+	@DbConn.invalidates_catalog
+	def create_table_as(self, table, query, schema=None, unlogged=False, analyze=True):
+		""" create a table holding the result of a query and analyze it.
+		 unlogged tables are faster to write but emptied by a crash.
+		 returns the number of rows """
+		table_name = self._table_name(schema, table)
+		sql = "CREATE %sTABLE %s AS %s" % ("UNLOGGED " if unlogged else "", table_name, query)
+		c = self.con.cursor()
+		self._exec_sql(c, sql)
+		rows = c.rowcount
+		if analyze:
+			self._exec_sql(c, "ANALYZE %s" % table_name)
+		self.con.commit()
+		return rows
+		
+	def analyze_table(self, table, schema=None):
+		""" update the planner statistics of a table """
+		self._exec_sql_and_commit("ANALYZE %s" % self._table_name(schema, table))
+		
+	@DbConn.invalidates_catalog
+	def materialize(self, table, query, geom_column, schema=None):
+		""" create a table from a query, with a spatial index on geom_column, so that
+		 a layer on it doesn't run the query again on every redraw.
+		 the schema is created if needed. the table is dropped if it can't be completed.
+		 returns (schema, table) """
+		if not schema:
+			c = self.con.cursor()
+			self._exec_sql(c, "SELECT current_schema()")
+			schema = c.fetchone()[0]
+		else:
+			self.create_schema(schema, if_not_exists=True)
+		self.create_table_as(table, query, schema, analyze=False)
+		try:
+			self.create_spatial_index(table, schema, geom_column)
+			self.analyze_table(table, schema)
+		except DbConn.DbError:
+			self.delete_table(table, schema)
+			raise
+		return schema, table
+		
+	# int8, int2 and int4
+	INTEGER_TYPE_OIDS = (20, 21, 23)
+	
+	@DbConn.cached_catalog
+	def get_geometry_type_oids(self):
+		""" oids of the geometry and geography types, they change from a database to another """
+		c = self.con.cursor()
+		self._exec_sql(c, "SELECT oid FROM pg_type WHERE typname IN ('geometry', 'geography')")
+		return frozenset( [row[0] for row in c.fetchall()] )
+		
+	def get_query_columns(self, query):
+		""" (name, kind) of the columns of a query's result, kind is 'geometry', 'integer' or None.
+		 the query is planned but returns no row (LIMIT 0), the kinds come from the type oids """
+		c = self.con.cursor()
+		self._exec_sql(c, u"SELECT * FROM (%s\n) AS subquery LIMIT 0" % query)
+		description = c.description
+		geometry_oids = self.get_geometry_type_oids()
+		columns = []
+		for column in description:
+			name, type_code = column[0], column[1]
+			if type_code in geometry_oids:
+				kind = 'geometry'
+			elif type_code in self.INTEGER_TYPE_OIDS:
+				kind = 'integer'
+			else:
+				kind = None
+			columns.append( (unicode(name, 'utf-8') if isinstance(name, str) else name, kind) )
+		return columns
+		
+	def get_query_metadata(self, query, geom_column):
+		""" extent, feature count, geometry type and srid of a query's result, computed
+		 with a single scan. returns a dict: 'extent' is (xmin, ymin, xmax, ymax) or None,
+		 'type' (e.g. 'POINTZ') and 'srid' are None if the geometries don't share them """
+		sql = u"""SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e), n,
+				CASE WHEN t1 = t2 THEN t1 END, CASE WHEN s1 = s2 THEN s1 END
+			FROM (SELECT ST_Extent(g) AS e, count(*) AS n,
+					min(t) AS t1, max(t) AS t2,
+					min(ST_SRID(g)) AS s1, max(ST_SRID(g)) AS s2
+				FROM (SELECT g, upper(substr(ST_GeometryType(g), 4)) || CASE ST_Zmflag(g)
+							WHEN 1 THEN 'M' WHEN 2 THEN 'Z' WHEN 3 THEN 'ZM' ELSE '' END AS t
+					FROM (SELECT %s::geometry AS g FROM (%s\n) AS subquery) AS typed) AS geoms) AS m"""
+		c = self.con.cursor()
+		self._exec_sql(c, sql % (self._quote(geom_column), query))
+		return self._metadata(c.fetchone())
+		
+	def get_table_metadata(self, table, geom_column, schema=None):
+		""" like get_query_metadata, for an analyzed table, without reading it: the extent
+		 and the feature count are the estimates kept by the planner statistics, the type
+		 and the srid come from geometry_columns """
+		c = self.con.cursor()
+		if not schema:
+			self._exec_sql(c, "SELECT current_schema()")
+			schema = c.fetchone()[0]
+		if self.has_geometry_columns and self.has_geometry_columns_access:
+			geometry_columns = """(SELECT %s FROM geometry_columns
+					WHERE f_table_schema = %%(schema)s AND f_table_name = %%(table)s AND f_geometry_column = %%(geom)s)"""
+			# the type is e.g. POINTM, or POINT with 3 or 4 dimensions
+			geom_type = geometry_columns % """upper(type) || CASE WHEN coord_dimension = 4 THEN 'ZM'
+					WHEN coord_dimension = 3 AND substr(upper(type), length(type)) <> 'M' THEN 'Z' ELSE '' END"""
+			srid = geometry_columns % "NULLIF(srid, 0)"
+		else:
+			geom_type = srid = "NULL"
+		sql = u"""SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e),
+				(SELECT reltuples::bigint FROM pg_class WHERE oid = %%(name)s::regclass), %s, %s
+			FROM (SELECT ST_EstimatedExtent(%%(schema)s, %%(table)s, %%(geom)s) AS e) AS m""" % (geom_type, srid)
+		params = { 'schema' : schema, 'table' : table, 'geom' : geom_column, 'name' : self._table_name(schema, table) }
+		self._exec_sql(c, sql, params)
+		return self._metadata(c.fetchone())
+		
+	def _metadata(self, row):
+		extent = tuple(row[:4]) if row[0] is not None else None
+		return { 'extent' : extent, 'count' : row[4], 'type' : row[5], 'srid' : row[6] }
+		
+	def explain(self, query, analyze=False):
+		""" the plan of a query (EXPLAIN (FORMAT JSON)), the root PlanNode. with analyze the
+		 query is run, then rolled back, and the nodes get their actual time and rows """
+		c = self.con.cursor()
+		try:
+			self._exec_sql(c, u"EXPLAIN (%sFORMAT JSON) %s" % ("ANALYZE, " if analyze else "", query))
+			plan = c.fetchone()[0]
+		finally:
+			self.con.rollback()
+		# a json column is decoded by psycopg2 >= 2.5 only
+		if isinstance(plan, basestring):
+			plan = json.loads(plan)
+		tables = set( [row[0].lower() for row in self.list_geotables() if row[6] is not None] )
+		return self.flag_geometry_scans(PlanNode(plan[0]['Plan']), tables)
+		
+	def get_table_size(self, table, schema=None):
+		""" bytes used by a table, its indexes and toast table included """
+		c = self.con.cursor()
+		self._exec_prepared(c, "table_size", "SELECT pg_total_relation_size($1::regclass)", (self._table_name(schema, table),), ("text",))
+		return c.fetchone()[0]
+	
+	@DbConn.invalidates_catalog
 	def delete_view(self, name, schema=None):
 		view_name = self._table_name(schema, name)
 		sql = "DROP VIEW %s" % view_name
@@ -510,16 +767,20 @@ class Connection(DbConn.Connection):
 		""" rename view in database """
 		self.rename_table(name, new_name, schema)
 		
-	def create_schema(self, schema):
-		""" create a new empty schema in database """
-		sql = "CREATE SCHEMA %s" % self._quote(schema)
+	@DbConn.invalidates_catalog
+	def create_schema(self, schema, if_not_exists=False):
+		""" create a new empty schema in database. with if_not_exists an existing
+		 schema is no error (postgresql >= 9.3) """
+		sql = "CREATE SCHEMA %s%s" % ("IF NOT EXISTS " if if_not_exists else "", self._quote(schema))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def delete_schema(self, schema):
 		""" drop (empty) schema from database """
 		sql = "DROP SCHEMA %s" % self._quote(schema)
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def rename_schema(self, schema, new_schema):
 		""" rename a schema in database """
 		sql = "ALTER SCHEMA %s RENAME TO %s" % (self._quote(schema), self._quote(new_schema))
@@ -527,21 +788,24 @@ class Connection(DbConn.Connection):
 		
 		# update geometry_columns if postgis is enabled
 		if self.has_spatial:
-			sql = "UPDATE geometry_columns SET f_table_schema='%s' WHERE f_table_schema='%s'" % (self._quote_str(new_schema), self._quote_str(schema)) 
-			self._exec_sql_and_commit(sql)
+			sql = "UPDATE geometry_columns SET f_table_schema=%s WHERE f_table_schema=%s"
+			self._exec_sql_and_commit(sql, (new_schema, schema))
 		
+	@DbConn.invalidates_catalog
 	def table_add_column(self, table, field, schema=None):
 		""" add a column to table (passed as TableField instance) """
 		table_name = self._table_name(schema, table)
 		sql = "ALTER TABLE %s ADD %s" % (table_name, field.field_def(self))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_delete_column(self, table, field, schema=None):
 		""" delete column from a table """
 		table_name = self._table_name(schema, table)
 		sql = "ALTER TABLE %s DROP %s" % (table_name, self._quote(field))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_column_rename(self, table, name, new_name, schema=None):
 		""" rename column in a table """
 		table_name = self._table_name(schema, table)
@@ -550,17 +814,21 @@ class Connection(DbConn.Connection):
 		
 		# update geometry_columns if postgis is enabled
 		if self.has_spatial:
-			sql = "UPDATE geometry_columns SET f_geometry_column='%s' WHERE f_geometry_column='%s' AND f_table_name='%s'" % (self._quote_str(new_name), self._quote_str(name), self._quote_str(table))
+			sql = "UPDATE geometry_columns SET f_geometry_column=%s WHERE f_geometry_column=%s AND f_table_name=%s"
+			params = [new_name, name, table]
 			if schema is not None:
-				sql += " AND f_table_schema='%s'" % self._quote(schema)
-			self._exec_sql_and_commit(sql)
+				sql += " AND f_table_schema=%s"
+				params.append(schema)
+			self._exec_sql_and_commit(sql, params)
 
+	@DbConn.invalidates_catalog
 	def table_column_set_type(self, table, column, data_type, schema=None):
 		""" change column type """
 		table_name = self._table_name(schema, table)
 		sql = "ALTER TABLE %s ALTER %s TYPE %s" % (table_name, self._quote(column), data_type)
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_column_set_default(self, table, column, default, schema=None):
 		""" change column's default value. If default=None drop default value """
 		table_name = self._table_name(schema, table)
@@ -570,6 +838,7 @@ class Connection(DbConn.Connection):
 			sql = "ALTER TABLE %s ALTER %s DROP DEFAULT" % (table_name, self._quote(column))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_column_set_null(self, table, column, is_null, schema=None):
 		""" change whether column can contain null values """
 		table_name = self._table_name(schema, table)
@@ -580,24 +849,28 @@ class Connection(DbConn.Connection):
 			sql += "SET NOT NULL"
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_add_primary_key(self, table, column, schema=None):
 		""" add a primery key (with one column) to a table """
 		table_name = self._table_name(schema, table)
 		sql = "ALTER TABLE %s ADD PRIMARY KEY (%s)" % (table_name, self._quote(column))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_add_unique_constraint(self, table, column, schema=None):
 		""" add a unique constraint to a table """
 		table_name = self._table_name(schema, table)
 		sql = "ALTER TABLE %s ADD UNIQUE (%s)" % (table_name, self._quote(column))
 		self._exec_sql_and_commit(sql)
 	
+	@DbConn.invalidates_catalog
 	def table_delete_constraint(self, table, constraint, schema=None):
 		""" delete constraint in a table """
 		table_name = self._table_name(schema, table)
 		sql = "ALTER TABLE %s DROP CONSTRAINT %s" % (table_name, self._quote(constraint))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_move_to_schema(self, table, new_schema, schema=None):
 		if new_schema == schema:
 			return
@@ -607,10 +880,12 @@ class Connection(DbConn.Connection):
 		
 		# update geometry_columns if postgis is enabled
 		if self.has_spatial:
-			sql = "UPDATE geometry_columns SET f_table_schema='%s' WHERE f_table_name='%s'" % (self._quote_str(new_schema), self._quote_str(table))
+			sql = "UPDATE geometry_columns SET f_table_schema=%s WHERE f_table_name=%s"
+			params = [new_schema, table]
 			if schema is not None:
-				sql += " AND f_table_schema='%s'" % self._quote_str(schema)
-			self._exec_sql_and_commit(sql)
+				sql += " AND f_table_schema=%s"
+				params.append(schema)
+			self._exec_sql_and_commit(sql, params)
 
 	def table_apply_function(self, schema, table, res_column, fct, param):
 		""" apply a function to a column and save the result in other column """
@@ -618,30 +893,35 @@ class Connection(DbConn.Connection):
 		sql = "UPDATE %s SET %s = %s(%s)" % (table, self._quote(res_column), fct, self._quote(param))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_enable_triggers(self, table, schema, enable=True):
 		""" enable or disable all triggers on table """
 		table = self._table_name(schema, table)
 		sql = "ALTER TABLE %s %s TRIGGER ALL" % (table, "ENABLE" if enable else "DISABLE")
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_enable_trigger(self, table, schema, trigger, enable=True):
 		""" enable or disable one trigger on table """
 		table = self._table_name(schema, table)
 		sql = "ALTER TABLE %s %s TRIGGER %s" % (table, "ENABLE" if enable else "DISABLE", self._quote(trigger))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def table_delete_trigger(self, table, schema, trigger):
 		""" delete trigger on table """
 		table = self._table_name(schema, table)
 		sql = "DROP TRIGGER %s ON %s" % (self._quote(trigger), table)
 		self._exec_sql_and_commit(sql)
 
+	@DbConn.invalidates_catalog
 	def table_delete_rule(self, table, schema, rule):
 		""" delete rule on table """
 		table = self._table_name(schema, table)
 		sql = "DROP RULE %s ON %s" % (self._quote(rule), table)
 		self._exec_sql_and_commit(sql)
 
+	@DbConn.invalidates_catalog
 	def create_index(self, table, name, column, schema=None):
 		""" create index on one column using default options """
 		table_name = self._table_name(schema, table)
@@ -649,40 +929,62 @@ class Connection(DbConn.Connection):
 		sql = "CREATE INDEX %s ON %s (%s)" % (idx_name, table_name, self._quote(column))
 		self._exec_sql_and_commit(sql)
 	
+	@DbConn.invalidates_catalog
 	def create_spatial_index(self, table, schema=None, geom_column='the_geom'):
 		table_name = self._table_name(schema, table)
 		idx_name = self._quote("sidx_"+table)
-		sql = "CREATE INDEX %s ON %s USING GIST(%s GIST_GEOMETRY_OPS)" % (idx_name, table_name, self._quote(geom_column))
+		sql = "CREATE INDEX %s ON %s USING GIST(%s)" % (idx_name, table_name, self._quote(geom_column))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def delete_index(self, name, schema=None):
 		index_name = self._table_name(schema, name)
 		sql = "DROP INDEX %s" % index_name
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.cached_catalog
 	def get_database_privileges(self):
 		""" db privileges: (can create schemas, can create temp. tables) """
-		sql = "SELECT has_database_privilege('%(d)s', 'CREATE'), has_database_privilege('%(d)s', 'TEMP')" % { 'd' : self._quote_str(self.dbname) }
+		sql = "SELECT has_database_privilege($1, 'CREATE'), has_database_privilege($1, 'TEMP')"
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "database_privileges", sql, (self.dbname,), ("text",))
 		return c.fetchone()
 		
+	@DbConn.cached_catalog
 	def get_schema_privileges(self, schema):
 		""" schema privileges: (can create new objects, can access objects in schema) """
-		sql = "SELECT has_schema_privilege('%(s)s', 'CREATE'), has_schema_privilege('%(s)s', 'USAGE')" % { 's' : self._quote_str(schema) }
+		sql = "SELECT has_schema_privilege($1, 'CREATE'), has_schema_privilege($1, 'USAGE')"
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "schema_privileges", sql, (schema,), ("text",))
 		return c.fetchone()
 	
+	@DbConn.cached_catalog
 	def get_table_privileges(self, table, schema=None):
 		""" table privileges: (select, insert, update, delete) """
 		t = self._table_name(schema, table)
-		sql = """SELECT has_table_privilege('%(t)s', 'SELECT'), has_table_privilege('%(t)s', 'INSERT'),
-		                has_table_privilege('%(t)s', 'UPDATE'), has_table_privilege('%(t)s', 'DELETE')""" % { 't': self._quote_str(t) }
+		sql = """SELECT has_table_privilege($1, 'SELECT'), has_table_privilege($1, 'INSERT'),
+		                has_table_privilege($1, 'UPDATE'), has_table_privilege($1, 'DELETE')"""
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_prepared(c, "table_privileges", sql, (t,), ("text",))
 		return c.fetchone()
+
+	@DbConn.cached_catalog
+	def get_tables_privileges(self, schema):
+		""" privileges of all the tables and views in a schema, with a single query.
+		 returns a dict: table name -> (select, insert, update, delete) """
+		sql = """SELECT c.relname, has_table_privilege(c.oid, 'SELECT'), has_table_privilege(c.oid, 'INSERT'),
+				has_table_privilege(c.oid, 'UPDATE'), has_table_privilege(c.oid, 'DELETE')
+			FROM pg_class c
+			JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+			WHERE nspname = $1 AND c.relkind IN ('v', 'r')"""
+		c = self.con.cursor()
+		self._exec_prepared(c, "tables_privileges", sql, (schema,), ("text",))
+		privileges = {}
+		for row in c.fetchall():
+			privileges[row[0]] = row[1:]
+		return privileges
 	
+	@DbConn.invalidates_catalog
 	def vacuum_analyze(self, table, schema=None):
 		""" run vacuum analyze on a table """
 		t = self._table_name(schema, table)
@@ -692,13 +994,14 @@ class Connection(DbConn.Connection):
 		self._exec_sql(c, "VACUUM ANALYZE %s" % t)
 		self.con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
 		
+	@DbConn.cached_catalog
 	def sr_info_for_srid(self, srid):
 		if not self.has_spatial:
 			return "Unknown"
 		
 		try:
 			c = self.con.cursor()
-			self._exec_sql(c, "SELECT srtext FROM spatial_ref_sys WHERE srid = '%d'" % srid)
+			self._exec_prepared(c, "srtext", "SELECT srtext FROM spatial_ref_sys WHERE srid = $1", (srid,), ("integer",))
 			sr = c.fetchone()
 			if sr is None:
 				return "Unknown"
@@ -714,7 +1017,7 @@ class Connection(DbConn.Connection):
 	def insert_table_row(self, table, values, schema=None, cursor=None):
 		""" insert a row with specified values to a table.
 		 if a cursor is specified, it doesn't commit (expecting that there will be more inserts)
-		 otherwise it commits immediately """
+		 otherwise it commits immediately. to load many rows use bulk_insert """
 		t = self._table_name(schema, table)
 		sql = ""
 		for value in values:
@@ -727,7 +1030,83 @@ class Connection(DbConn.Connection):
 		else:
 			self._exec_sql_and_commit(sql)
 
-
+	def bulk_insert(self, table, rows, schema=None, columns=None, batch_size=10000, progress=None):
+		""" insert many rows (tuples of python values) to a table, much faster than insert_table_row.
+		 rows are buffered in memory and sent by a COPY FROM STDIN every batch_size rows, each batch
+		 is committed. progress(inserted rows, rows per second) is called after every batch.
+		 returns a tuple (inserted rows, rows per second) """
+		t = self._table_name(schema, table)
+		# the bytea columns get their values hex encoded
+		c = self.con.cursor()
+		self._exec_sql(c, "SELECT %s FROM %s LIMIT 0" % (", ".join( map(self._quote, columns) ) if columns else "*", t))
+		binary = [column[1] == self.BYTEA_TYPE_OID for column in c.description]
+		if columns:
+			t += " (%s)" % ", ".join( map(self._quote, columns) )
+		sql = "COPY %s FROM STDIN" % t
+		encoding = psycopg2.extensions.encodings[self.con.encoding]
+
+		start = time.time()
+		count = 0
+		buf = StringIO()
+		buffered = 0
+		for index, row in enumerate(rows):
+			# zip() would silently drop the extra values or leave columns out
+			if len(row) != len(binary):
+				raise DbConn.DbError( u"row %d has %d values, the table %d columns" % (index, len(row), len(binary)) )
+			buf.write( "\t".join( [self._copy_value(v, encoding, b) for v, b in zip(row, binary)] ) )
+			buf.write( "\n" )
+			buffered += 1
+			if buffered >= batch_size:
+				count += self._copy_batch(sql, buf, buffered)
+				buf, buffered = StringIO(), 0
+				if progress:
+					progress(count, count / max(time.time() - start, 1e-6))
+
+		if buffered > 0:
+			count += self._copy_batch(sql, buf, buffered)
+
+		rate = count / max(time.time() - start, 1e-6)
+		if progress and buffered > 0:
+			progress(count, rate)
+		return count, rate
+
+	def _copy_batch(self, sql, buf, rows):
+		buf.seek(0)
+		c = self.con.cursor()
+		try:
+			c.copy_expert(sql, buf)
+		except psycopg2.Error, e:
+			self.con.rollback()
+			raise DbError(e)
+		self.con.commit()
+		return rows
+
+	BYTEA_TYPE_OID = 17
+
+	def _copy_value(self, value, encoding, binary=False):
+		""" convert a value to the COPY text format, binary for a bytea column """
+		if value is None:
+			return "\\N"
+		if isinstance(value, bool):
+			return "t" if value else "f"
+		if binary and not isinstance(value, unicode):
+			# hex format, its backslash escaped for COPY
+			return "\\\\x" + str(value).encode('hex')
+		if isinstance(value, float):
+			# str() keeps 12 significant digits only
+			if value != value:
+				return "NaN"
+			if value in (float('inf'), float('-inf')):
+				return "Infinity" if value > 0 else "-Infinity"
+			return repr(value)
+		if isinstance(value, unicode):
+			value = value.encode(encoding)
+		elif not isinstance(value, str):
+			value = str(value)
+		return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+	@DbConn.invalidates_catalog
 	def table_add_function_trigger(self, schema, table, resColumn, fct, geomColumn):
 		""" add a trigger on insert and update that recalculates the value from geometry column """
 		
@@ -770,20 +1149,67 @@ class Connection(DbConn.Connection):
 		#cur_name = ("\"db_table_"+self.table+"\"").replace(' ', '_')
 		#cur_name = cur_name.encode('ascii','replace').replace('?', '_')
 		return self.con.cursor(cur_name)
+
+	def iter_query(self, sql, batch_size=1000, params=None):
+		""" run a query and yield its rows in lists of (at most) batch_size rows.
+		 rows are read from a server-side cursor, so only one batch at a time is held in memory """
+		c = self.get_named_cursor()
+		c.itersize = batch_size
+		self._exec_sql(c, sql, params)
+		try:
+			while True:
+				rows = self._fetch_many(c, batch_size)
+				if not rows:
+					break
+				yield rows
+		finally:
+			try:
+				c.close()
+			except psycopg2.Error, e:
+				# the transaction the cursor lived in is already gone
+				pass
+
+	def _fetch_many(self, cursor, size):
+		try:
+			return cursor.fetchmany(size)
+		except psycopg2.Error, e:
+			self.con.rollback()
+			raise DbError(e)
 		
-	def _exec_sql(self, cursor, sql):
+	def _exec_sql(self, cursor, sql, params=None):
 		try:
-			cursor.execute(sql)
+			if params is None:
+				cursor.execute(sql)
+			else:
+				cursor.execute(sql, params)
 		except psycopg2.Error, e:
 			# do the rollback to avoid a "current transaction aborted, commands ignored" errors
 			self.con.rollback()
 			raise DbError(e)
 		
-	def _exec_sql_and_commit(self, sql):
+	def _exec_prepared(self, cursor, name, sql, params=(), types=()):
+		""" execute a statement prepared once per connection, which saves the server
+		 from parsing and planning it again on each call. 'sql' uses $1, $2... placeholders
+		 whose types are listed in 'types' """
+		stmt = self.prepared.get(name)
+		if stmt is None:
+			stmt = "fsl_%s" % name
+			if types:
+				self._exec_sql(cursor, "PREPARE %s (%s) AS %s" % (stmt, ", ".join(types), sql))
+			else:
+				self._exec_sql(cursor, "PREPARE %s AS %s" % (stmt, sql))
+			self.prepared[name] = stmt
+
+		if params:
+			self._exec_sql(cursor, "EXECUTE %s (%s)" % (stmt, ", ".join( ["%s"] * len(params) )), params)
+		else:
+			self._exec_sql(cursor, "EXECUTE %s" % stmt)
+		
+	def _exec_sql_and_commit(self, sql, params=None):
 		""" tries to execute and commit some action, on error it rolls back the change """
 		#try:
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_sql(c, sql, params)
 		self.con.commit()
 		#except DbError, e:
 		#	self.con.rollback()
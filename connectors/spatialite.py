@@ -18,6 +18,10 @@ import qgis.core
 from pyspatialite import dbapi2 as sqlite
 from .. import DbConnection as DbConn
 
+from itertools import islice
+import re
+import time
+
 class TableAttribute(DbConn.TableAttribute):
 	def __init__(self, row):
 		self.num, self.name, self.data_type, self.notnull, self.default, self.primary_key = row
@@ -35,6 +39,17 @@ class TableTrigger(DbConn.TableTrigger):
 		self.enabled = True
 
 
+class PlanNode(DbConn.PlanNode):
+	# e.g. "SCAN TABLE roads AS r", "SEARCH roads USING INDEX ..."
+	RELATION = re.compile(r'^(?:SCAN|SEARCH) (?:TABLE )?"?([^" ]+)')
+
+	def __init__(self, detail):
+		""" detail is a row of EXPLAIN QUERY PLAN """
+		match = self.RELATION.match(detail)
+		DbConn.PlanNode.__init__(self, detail.split(' ')[0], match.group(1) if match else None, detail)
+		self.seq_scan = self.name == 'SCAN' and 'INDEX' not in detail
+
+
 class DbError(DbConn.DbError):
 	def __init__(self, error, query=None):
 		print type(error), dir(error), error, error.args[0]
@@ -73,6 +88,10 @@ class Connection(DbConn.Connection):
 
 	@classmethod
 	def connect(self, selected, parent=None):
+		return Connection(self.getSettingsURI(selected))
+
+	@classmethod
+	def getSettingsURI(self, selected):
 		settings = QSettings()
 		settings.beginGroup( u"/%s/connections/%s" % (self.getSettingsKey(), selected) )
 
@@ -83,7 +102,7 @@ class Connection(DbConn.Connection):
 
 		uri = qgis.core.QgsDataSourceURI()
 		uri.setDatabase(database)
-		return Connection(uri)
+		return uri
 
 
 	def __init__(self, uri):
@@ -91,9 +110,15 @@ class Connection(DbConn.Connection):
 	
 		self.dbname = uri.database()		
 		try:
-			self.con = sqlite.connect( self.con_info() )
+			# pooled connections are used by the query worker thread too.
+			# compiled statements are reused by sqlite as long as the sql text
+			# doesn't change, that's why values are bound as parameters
+			self.con = sqlite.connect( self.con_info(), check_same_thread=False, cached_statements=200 )
 		except sqlite.OperationalError, e:
 			raise DbError(e)
+
+		# PRAGMA functions (e.g. pragma_table_info) accept bound parameters, sqlite >= 3.16
+		self.has_pragma_functions = sqlite.sqlite_version_info >= (3, 16, 0)
 		
 		self.has_spatial = self.check_spatial()
 
@@ -103,6 +128,14 @@ class Connection(DbConn.Connection):
 	def con_info(self):
 		return '%s' % self.dbname
 		
+	def cancel(self):
+		""" abort the running query """
+		try:
+			self.con.interrupt()
+		except sqlite.Error, e:
+			# e.g. the connection was closed meanwhile
+			pass
+
 	def get_info(self):
 		c = self.con.cursor()
 		self._exec_sql(c, "SELECT sqlite_version()")
@@ -130,6 +163,7 @@ class Connection(DbConn.Connection):
 		self._exec_sql(c, "SELECT spatialite_version(), NULL, NULL, geos_version(), proj4_version(), NULL")
 		return c.fetchone()
 					
+	@DbConn.cached_catalog
 	def list_geotables(self):
 		"""
 			get list of tables, whether table has geometry column(s) etc.
@@ -179,11 +213,16 @@ class Connection(DbConn.Connection):
 		return c.fetchone()[0]
 		
 		
+	@DbConn.cached_catalog
 	def get_table_fields(self, table, schema=None):
 		""" return list of columns in table """
 		c = self.con.cursor()
-		sql = "PRAGMA table_info(%s)" % (self._quote(table))
-		self._exec_sql(c, sql)
+		if self.has_pragma_functions:
+			sql = "SELECT cid, name, type, \"notnull\", dflt_value, pk FROM pragma_table_info(?)"
+			self._exec_sql(c, sql, (table,))
+		else:
+			sql = "PRAGMA table_info(%s)" % (self._quote(table))
+			self._exec_sql(c, sql)
 
 		attrs = []
 		for row in c.fetchall():
@@ -192,14 +231,24 @@ class Connection(DbConn.Connection):
 		return attrs
 		
 		
+	@DbConn.cached_catalog
 	def get_table_indexes(self, table, schema=None):
 		""" get info about table's indexes """
 		c = self.con.cursor()
+		if self.has_pragma_functions:
+			# indexes and their columns in one query
+			sql = """SELECT il.seq, il.name, il."unique", ii.cid
+							FROM pragma_index_list(?) AS il LEFT JOIN pragma_index_info(il.name) AS ii
+							ORDER BY il.seq, ii.seqno"""
+			self._exec_sql(c, sql, (table,))
+			return self._group_index_rows(c.fetchall())
+
 		sql = "PRAGMA index_list(%s)" % (self._quote(table))
 		self._exec_sql(c, sql)
 
 		indexes = []
-		for num, name, unique in c.fetchall():
+		for item in c.fetchall():
+			num, name, unique = item[:3]
 			c2 = self.con.cursor()
 			sql = "PRAGMA index_info(%s)" % (self._quote(name))
 			self._exec_sql(c2, sql)
@@ -213,12 +262,23 @@ class Connection(DbConn.Connection):
 			indexes.append( TableIndex(row) )
 
 		return indexes
+
+	def _group_index_rows(self, rows):
+		""" make TableIndex instances from (num, name, unique, column id) rows sorted by index """
+		indexes = []
+		for num, name, unique, cid in rows:
+			if not indexes or indexes[-1].name != name:
+				indexes.append( TableIndex([num, name, unique, []]) )
+			if cid is not None:
+				indexes[-1].columns.append(cid)
+		return indexes
 	
 	
+	@DbConn.cached_catalog
 	def get_table_triggers(self, table, schema=None):
 		c = self.con.cursor()
-		sql = "SELECT name, sql FROM sqlite_master WHERE tbl_name = %s AND type = 'trigger'" % (self._quote_str(table))
-		self._exec_sql(c, sql)
+		sql = "SELECT name, sql FROM sqlite_master WHERE tbl_name = ? AND type = 'trigger'"
+		self._exec_sql(c, sql, (table,))
 		
 		triggers = []
 		for row in c.fetchall():
@@ -227,6 +287,49 @@ class Connection(DbConn.Connection):
 		return triggers
 
 	# TODO get_table_constraints		
+
+	@DbConn.cached_catalog
+	def describe_all_tables(self):
+		""" returns a dict: table name -> TableDescription with fields, indexes and triggers
+		 of all the tables and views. it needs a few queries instead of some per table """
+		c = self.con.cursor()
+		self._exec_sql(c, "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")
+		tables = {}
+		for (name,) in c.fetchall():
+			tables[name] = DbConn.TableDescription(name)
+
+		if not self.has_pragma_functions:
+			# older sqlite: the pragmas can't be joined, describe a table at a time
+			for name, desc in tables.iteritems():
+				desc.fields = self.get_table_fields(name)
+				desc.indexes = self.get_table_indexes(name)
+		else:
+			sql = """SELECT m.name, p.cid, p.name, p.type, p."notnull", p.dflt_value, p.pk
+							FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+							WHERE m.type IN ('table', 'view')
+							ORDER BY m.name, p.cid"""
+			self._exec_sql(c, sql)
+			for row in c.fetchall():
+				tables[row[0]].fields.append( TableAttribute(row[1:]) )
+
+			sql = """SELECT m.name, il.seq, il.name, il."unique", ii.cid
+							FROM sqlite_master AS m JOIN pragma_index_list(m.name) AS il
+							LEFT JOIN pragma_index_info(il.name) AS ii
+							WHERE m.type = 'table'
+							ORDER BY m.name, il.seq, ii.seqno"""
+			self._exec_sql(c, sql)
+			rows = {}
+			for row in c.fetchall():
+				rows.setdefault(row[0], []).append(row[1:])
+			for name, index_rows in rows.iteritems():
+				tables[name].indexes = self._group_index_rows(index_rows)
+
+		self._exec_sql(c, "SELECT tbl_name, name, sql FROM sqlite_master WHERE type = 'trigger'")
+		for row in c.fetchall():
+			if row[0] in tables:
+				tables[row[0]].triggers.append( TableTrigger(row[1:]) )
+
+		return tables
 	
 	def get_table_estimated_extent(self, geom, table, schema=None):
 		""" find out estimated extent (from the statistics) """
@@ -238,27 +341,42 @@ class Connection(DbConn.Connection):
 		row = c.fetchone()
 		return row
 	
+	@DbConn.cached_catalog
 	def get_view_definition(self, view, schema=None):
 		""" returns definition of the view """
-		sql = "SELECT sql FROM sqlite_master WHERE type = 'view' AND name = %s" % (self._quote_str(view))
+		sql = "SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?"
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_sql(c, sql, (view,))
 		return c.fetchone()[0]
 		
+	@DbConn.invalidates_catalog
 	def add_geometry_column(self, table, geom_type, geom_column='the_geom', srid=-1, dim='XY'):
-		sql = "SELECT AddGeometryColumn('%s', '%s', %d, '%s', %s)" % (self._quote_str(table), self._quote_str(geom_column), srid, self._quote_str(geom_type), dim)
-		self._exec_sql_and_commit(sql)
+		sql = "SELECT AddGeometryColumn(?, ?, ?, ?, ?)"
+		self._exec_sql_and_commit(sql, (table, geom_column, srid, geom_type, dim))
 		
+	@DbConn.invalidates_catalog
 	def delete_geometry_column(self, table, geom_column):
 		""" discard a geometry column """
-		sql = "SELECT DiscardGeometryColumn('%s', '%s')" % (self._quote_str(table), self._quote_str(geom_column))
-		self._exec_sql_and_commit(sql)
+		sql = "SELECT DiscardGeometryColumn(?, ?)"
+		self._exec_sql_and_commit(sql, (table, geom_column))
 		
+	@DbConn.invalidates_catalog
 	def delete_geometry_table(self, table):
-		""" delete table with one or more geometries """
+		""" delete table with one or more geometries, their registration
+		 in geometry_columns and their spatial indexes """
+		if self.has_geometry_columns:
+			c = self.con.cursor()
+			sql = "SELECT f_geometry_column, spatial_index_enabled FROM geometry_columns WHERE lower(f_table_name) = lower(?)"
+			self._exec_sql(c, sql, (table,))
+			for geom_column, indexed in c.fetchall():
+				if indexed:
+					self._exec_sql(c, "SELECT DisableSpatialIndex(?, ?)", (table, geom_column))
+					self._exec_sql(c, "DROP TABLE IF EXISTS %s" % self._quote("idx_%s_%s" % (table, geom_column)))
+				self._exec_sql(c, "SELECT DiscardGeometryColumn(?, ?)", (table, geom_column))
 		sql = "DROP TABLE %s" % (self._quote(table))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def create_table(self, table, fields, pkey=None):
 		""" create ordinary table
 				'fields' is array containing instances of TableField
@@ -279,6 +397,7 @@ class Connection(DbConn.Connection):
 		self._exec_sql_and_commit(sql)
 		return True
 	
+	@DbConn.invalidates_catalog
 	def delete_table(self, table):
 		""" delete table from the database """
 		table_name = self._quote(table)
@@ -290,6 +409,7 @@ class Connection(DbConn.Connection):
 		sql = "DELETE FROM %s" % self._quote(table)
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def rename_table(self, table, new_table):
 		""" rename a table """
 		sql = "ALTER TABLE %s RENAME TO %s" % (self._quote(table), self._quote(new_table))
@@ -297,13 +417,144 @@ class Connection(DbConn.Connection):
 		
 		# update geometry_columns
 		if self.has_geometry_columns:
-			sql = "UPDATE geometry_columns SET f_table_name = %s WHERE f_table_name = %s" % (self._quote_str(new_table), self._quote_str(table))
-			self._exec_sql_and_commit(sql)
+			sql = "UPDATE geometry_columns SET f_table_name = ? WHERE f_table_name = ?"
+			self._exec_sql_and_commit(sql, (new_table, table))
 		
+	@DbConn.invalidates_catalog
 	def create_view(self, name, query):
 		sql = "CREATE VIEW %s AS %s" % (self._quote(name), query)
 		self._exec_sql_and_commit(sql)
 	
+	@DbConn.invalidates_catalog
+	def create_table_as(self, table, query):
+		""" create a table holding the result of a query. returns the number of rows """
+		table_name = self._quote(table)
+		c = self.con.cursor()
+		self._exec_sql(c, "CREATE TABLE %s AS %s" % (table_name, query))
+		self._exec_sql(c, "SELECT count(*) FROM %s" % table_name)
+		rows = c.fetchone()[0]
+		self.con.commit()
+		return rows
+	
+	def get_query_columns(self, query):
+		""" (name, kind) of the columns of a query's result, kind is 'geometry', 'integer' or None.
+		 sqlite results have no column types: they are guessed from the first row """
+		c = self.con.cursor()
+		self._exec_sql(c, u"SELECT * FROM (%s\n) AS subquery LIMIT 1" % query)
+		row = c.fetchone()
+		columns = []
+		for i, column in enumerate(c.description):
+			kind = self._value_kind(row[i]) if row is not None else None
+			columns.append( (column[0], kind) )
+		return columns
+		
+	def get_query_metadata(self, query, geom_column):
+		""" extent, feature count, geometry type and srid of a query's result, computed
+		 with a single scan. returns a dict: 'extent' is (xmin, ymin, xmax, ymax) or None,
+		 'type' and 'srid' are None if the geometries don't share them """
+		g = self._quote(geom_column)
+		sql = u"""SELECT Min(MbrMinX(%(g)s)), Min(MbrMinY(%(g)s)), Max(MbrMaxX(%(g)s)), Max(MbrMaxY(%(g)s)),
+				count(*), Min(GeometryType(%(g)s)), Max(GeometryType(%(g)s)), Min(SRID(%(g)s)), Max(SRID(%(g)s))
+			FROM (%(q)s\n) AS subquery""" % { 'g' : g, 'q' : query }
+		c = self.con.cursor()
+		self._exec_sql(c, sql)
+		row = c.fetchone()
+		extent = tuple(row[:4]) if row[0] is not None else None
+		# e.g. "POINT Z" with spatialite 4
+		geom_type = row[5] if row[5] is not None and row[5] == row[6] else None
+		srid = row[7] if row[7] == row[8] else None
+		return { 'extent' : extent, 'count' : row[4], 'type' : geom_type, 'srid' : srid }
+		
+	def get_table_metadata(self, table, geom_column, schema=None):
+		""" like get_query_metadata, for a table """
+		return self.get_query_metadata(u"SELECT * FROM %s" % self._quote(table), geom_column)
+		
+	def explain(self, query, analyze=False):
+		""" the plan of a query (EXPLAIN QUERY PLAN), the root PlanNode. sqlite has no cost nor
+		 estimated rows, and no timings per node: with analyze the query is run and the root
+		 gets the time it took and its rows """
+		c = self.con.cursor()
+		self._exec_sql(c, u"EXPLAIN QUERY PLAN %s" % query)
+		tree = c.description[1][0] == 'parent'  # sqlite >= 3.24, otherwise a flat list
+		root = DbConn.PlanNode("QUERY")
+		nodes = {}
+		for row in c.fetchall():
+			node = PlanNode(row[3])
+			if tree:
+				nodes[row[0]] = node
+				nodes.get(row[1], root).children.append(node)
+			else:
+				root.children.append(node)
+
+		if analyze:
+			started = time.time()
+			self._exec_sql(c, query)
+			rows = 0
+			while True:
+				batch = self._fetch_many(c, 1000)
+				if not batch:
+					break
+				rows += len(batch)
+			root.actual_time = (time.time() - started) * 1000
+			root.actual_rows, root.loops = rows, 1
+
+		tables = set( [item[0].lower() for item in self.list_geotables() if item[2] is not None] )
+		return self.flag_geometry_scans(root, tables)
+		
+	def _value_kind(self, value):
+		if isinstance(value, (int, long)) and not isinstance(value, bool):
+			return 'integer'
+		if isinstance(value, buffer):
+			# a spatialite geometry blob starts with 0x00, has 0x7C
+			# at offset 38 and ends with 0xFE
+			blob = str(value)
+			if len(blob) >= 44 and blob[0] == '\x00' and blob[38] == '\x7c' and blob[-1] == '\xfe':
+				return 'geometry'
+		return None
+		
+	@DbConn.invalidates_catalog
+	def recover_geometry_column(self, table, geom_column):
+		""" register a geometry column of a table created without AddGeometryColumn,
+		 its srid, type and dimension are the ones of the first geometry.
+		 returns False if the column has no geometry """
+		c = self.con.cursor()
+		sql = "SELECT SRID(%s), GeometryType(%s), CoordDimension(%s) FROM %s WHERE %s IS NOT NULL LIMIT 1"
+		geom = self._quote(geom_column)
+		self._exec_sql(c, sql % (geom, geom, geom, self._quote(table), geom))
+		row = c.fetchone()
+		if row is None or row[1] is None:
+			return False
+		srid, geom_type, dim = row
+		# e.g. "POINT Z" with spatialite 4
+		geom_type = geom_type.split(' ')[0]
+		self._exec_sql_and_commit("SELECT RecoverGeometryColumn(?, ?, ?, ?, ?)", (table, geom_column, srid, geom_type, dim))
+		return True
+		
+	def analyze_table(self, table):
+		""" update the statistics used by the query planner """
+		self._exec_sql_and_commit("ANALYZE %s" % self._quote(table))
+		
+	@DbConn.invalidates_catalog
+	def materialize(self, table, query, geom_column, schema=None):
+		""" create a table from a query, with a spatial index on geom_column, so that
+		 a layer on it doesn't run the query again on every redraw. sqlite has no
+		 schemas, 'schema' is ignored.
+		 returns (schema, table), the schema is always empty. the spatialite provider
+		 only opens registered geometry columns: raises DbError if it can't be registered """
+		if not self.has_geometry_columns:
+			raise DbConn.DbError(u"The database has no spatial metadata, the layer can't be materialized")
+		self.create_table_as(table, query)
+		try:
+			if not self.recover_geometry_column(table, geom_column):
+				raise DbConn.DbError(u"The geometry column %s can't be registered" % geom_column)
+			self.create_spatial_index(table, geom_column)
+			self.analyze_table(table)
+		except DbConn.DbError:
+			self.delete_geometry_table(table)
+			raise
+		return "", table
+	
+	@DbConn.invalidates_catalog
 	def delete_view(self, name):
 		sql = "DROP VIEW %s" % ( self.quote(name) )
 		self._exec_sql_and_commit(sql)
@@ -312,49 +563,56 @@ class Connection(DbConn.Connection):
 		""" rename view """
 		self.rename_table(name, new_name)
 		
+	@DbConn.invalidates_catalog
 	def table_add_column(self, table, field):
 		""" add a column to table (passed as TableField instance) """
 		sql = "ALTER TABLE %s ADD %s" % (self.quote(table), field.field_def(self))
 		self._exec_sql_and_commit(sql)
 	
+	@DbConn.invalidates_catalog
 	def table_delete_trigger(self, trigger):
 		""" delete trigger """
 		sql = "DROP TRIGGER %s" % (self._quote(trigger))
 		self._exec_sql_and_commit(sql)
 
+	@DbConn.invalidates_catalog
 	def create_index(self, table, name, column, unique=True):
 		""" create index on one column """
 		unique_str = "UNIQUE" if unique else ""
 		sql = "CREATE " + unique_str + " INDEX %s ON %s (%s)" % (self._quote(index), self.quote(table), self._quote(column))
 		self._exec_sql_and_commit(sql)
 	
+	@DbConn.invalidates_catalog
 	def create_spatial_index(self, table, geom_column='the_geom'):
 		table_name = self._quote(table)
 		idx_name = self._quote("sidx_"+table)
-		sql = "SELECT CreateSpatialIndex(%s, %s)" % (self._quote(table), self._quote(geom_column))
-		self._exec_sql_and_commit(sql)
+		sql = "SELECT CreateSpatialIndex(?, ?)"
+		self._exec_sql_and_commit(sql, (table, geom_column))
 
+	@DbConn.invalidates_catalog
 	def delete_index(self, name):
 		sql = "DROP INDEX %s" % (self._quote(name))
 		self._exec_sql_and_commit(sql)
 		
+	@DbConn.invalidates_catalog
 	def delete_spatial_index(self, name, geom_column='the_geom'):
-		sql = "SELECT DiscardSpatialIndex(%s, %s)" % (self._quote(name), self._quote(geom_column))
-		self._exec_sql_and_commit(sql)
+		sql = "SELECT DiscardSpatialIndex(?, ?)"
+		self._exec_sql_and_commit(sql, (name, geom_column))
 	
 	def vacuum(self):
 		""" run vacuum on the db """
 		self._exec_sql_and_commit("VACUUM")
 		
+	@DbConn.cached_catalog
 	def sr_info_for_srid(self, srid):
 		c = self.con.cursor()
-		self._exec_sql(c, "SELECT ref_sys_name FROM spatial_ref_sys WHERE srid = %s" % self._quote_str(srid))
+		self._exec_sql(c, "SELECT ref_sys_name FROM spatial_ref_sys WHERE srid = ?", (srid,))
 		return c.fetchone()[0]
 
 	def insert_table_row(self, table, values, cursor=None):
 		""" insert a row with specified values to a table.
 		 if a cursor is specified, it doesn't commit (expecting that there will be more inserts)
-		 otherwise it commits immediately """
+		 otherwise it commits immediately. to load many rows use bulk_insert """
 		sql = ""
 		for value in values:
 			# TODO: quote values?
@@ -365,19 +623,80 @@ class Connection(DbConn.Connection):
 			self._exec_sql(cursor, sql)
 		else:
 			self._exec_sql_and_commit(sql)
+
+	def bulk_insert(self, table, rows, columns=None, batch_size=10000, progress=None):
+		""" insert many rows (tuples of python values) to a table, much faster than insert_table_row.
+		 rows are sent by executemany in transactions of batch_size rows.
+		 progress(inserted rows, rows per second) is called after every batch.
+		 returns a tuple (inserted rows, rows per second) """
+		t = self._quote(table)
+		if columns:
+			t += " (%s)" % ", ".join( map(self._quote, columns) )
+
+		start = time.time()
+		count = 0
+		rate = 0
+		rows = iter(rows)
+		sql = None
+		while True:
+			batch = list( islice(rows, batch_size) )
+			if not batch:
+				break
+			if sql is None:
+				sql = "INSERT INTO %s VALUES (%s)" % (t, ", ".join( ["?"] * len(batch[0]) ))
+
+			c = self.con.cursor()
+			try:
+				c.executemany(sql, batch)
+			except sqlite.Error, e:
+				self.con.rollback()
+				raise DbError(e)
+			self.con.commit()
+
+			count += len(batch)
+			rate = count / max(time.time() - start, 1e-6)
+			if progress:
+				progress(count, rate)
+
+		return count, rate
 		
-	def _exec_sql(self, cursor, sql):
+	def iter_query(self, sql, batch_size=1000, params=None):
+		""" run a query and yield its rows in lists of (at most) batch_size rows,
+		 so only one batch at a time is held in memory """
+		c = self.con.cursor()
+		c.arraysize = batch_size
+		self._exec_sql(c, sql, params)
+		try:
+			while True:
+				rows = self._fetch_many(c, batch_size)
+				if not rows:
+					break
+				yield rows
+		finally:
+			c.close()
+
+	def _fetch_many(self, cursor, size):
+		try:
+			return cursor.fetchmany(size)
+		except sqlite.Error, e:
+			self.con.rollback()
+			raise DbError(e)
+
+	def _exec_sql(self, cursor, sql, params=None):
 		try:
-			cursor.execute(sql)
+			if params is None:
+				cursor.execute(sql)
+			else:
+				cursor.execute(sql, params)
 		except sqlite.Error, e:
 			# do the rollback to avoid a "current transaction aborted, commands ignored" errors
 			self.con.rollback()
 			raise DbError(e)
 		
-	def _exec_sql_and_commit(self, sql):
+	def _exec_sql_and_commit(self, sql, params=None):
 		""" tries to execute and commit some action, on error it rolls back the change """
 		c = self.con.cursor()
-		self._exec_sql(c, sql)
+		self._exec_sql(c, sql, params)
 		self.con.commit()
 
 	def _quote(self, identifier):
@@ -2,9 +2,9 @@
 import sys
 import re
 from PyQt4 import QtCore, QtGui
-from pygments import highlight
-from pygments.lexers import *
-from pygments.formatter import Formatter
+from sqltokenizer import scan_block, SqlTokenizer, SEGMENT_TOKENS
+from array import array
+from itertools import izip
 import time
 
 # Copyright (C) 2008 Christophe Kibleur <kib2@free.fr>
@@ -20,11 +20,19 @@ def hex2QColor(c):
     
 
 
-class QFormatter(Formatter):
+class QFormatter:
+    """ the formats of the tokens of a block, with the colors of a pygments
+    style. Only pygments.styles is needed, not the pygments formatters """
     
-    def __init__(self):
-        Formatter.__init__(self)
-        self.data=[]
+    def __init__(self, style='default'):
+        from pygments.styles import get_style_by_name
+        self.style=get_style_by_name(style)
+        
+        # Runs of characters sharing a style, stored as
+        # (offset, length, style) in three parallel arrays
+        self.starts=array('i')
+        self.lengths=array('i')
+        self.formats=[]
         
         # Create a dictionary of text styles, indexed
         # by pygments token names, containing QTextCharFormat
@@ -48,65 +56,157 @@ class QFormatter(Formatter):
             self.styles[str(token)]=qtf
     
     def format(self, tokensource, outfile):
-        global styles
         # We ignore outfile, keep output in a buffer
-        self.data=[]
-        
-        # Just store a list of styles, one for each character
-        # in the input. Obviously a smarter thing with
-        # offsets and lengths is a good idea!
+        self.starts=array('i')
+        self.lengths=array('i')
+        self.formats=[]
         
+        # Store one run per token, adjacent tokens with
+        # the same style are merged in a single run.
+        pos=0
         for ttype, value in tokensource:
             l=len(value)
-            t=str(ttype)                
-            self.data.extend([self.styles[t],]*l)
-
+            if not l:
+                continue
+            style=self.styles[str(ttype)]
+            if self.formats and self.formats[-1] is style:
+                self.lengths[-1]+=l
+            else:
+                self.starts.append(pos)
+                self.lengths.append(l)
+                self.formats.append(style)
+            pos+=l
+    
+    def runs(self):
+        """ (offset, length, style) of every run """
+        return izip(self.starts, self.lengths, self.formats)
+    
 
 class Highlighter(QtGui.QSyntaxHighlighter):
 
-    def __init__(self, parent, mode):
+    # Documents bigger than this (in characters) are highlighted
+    # in the background: no more than TIME_SLICE seconds are spent
+    # highlighting at once, the other blocks wait for a timer, so
+    # the editor keeps accepting input.
+    LARGE_DOCUMENT=100000
+    TIME_SLICE=0.02
+    DEBOUNCE_DELAY=150 # ms
+
+    def __init__(self, parent, mode, engine='fast'):
+        """ engine is 'fast' for our own SQL tokenizer, or 'pygments'
+        for the pygments lexer of mode.
+        """
         QtGui.QSyntaxHighlighter.__init__(self, parent)
         self.tstamp=time.time()
+        self.sliceStart=self.tstamp
         
         # Keep the formatter and lexer, initializing them 
         # may be costly.
         self.formatter=QFormatter()
-        self.lexer=get_lexer_by_name(mode)
+        if engine=='fast' and mode=='sql':
+            self.lexer=SqlTokenizer()
+        else:
+            # Only imported when needed, pygments.lexers is big
+            from pygments.lexers import get_lexer_by_name
+            self.lexer=get_lexer_by_name(mode)
+        
+        # The deferred blocks are between these block numbers
+        self.pendingFrom=None
+        self.pendingTo=None
+        self.pendingBlockCount=0
+        self.timer=QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        QtCore.QObject.connect(self.timer, QtCore.SIGNAL("timeout()"), self.highlightPending)
         
     def highlightBlock(self, text):
         """Takes a block, applies format to the document. 
         according to what's in it.
         """
         
-        # I need to know where in the document we are,
-        # because our formatting info is global to
-        # the document
-        cb = self.currentBlock()
-        p = cb.position()
-
-        # The \n is not really needed, but sometimes  
-        # you are in an empty last block, so your position is
-        # **after** the end of the document.
-        text=unicode(self.document().toPlainText())+'\n'
+        now=time.time()
+        number=self.currentBlock().blockNumber()
+        if self.pendingFrom is not None and number<self.pendingFrom:
+            # Edits before the deferred blocks move them
+            self.pendingFrom=number
+        if self.deferring(now):
+            self.defer(number)
+            self.tstamp=now
+            return
+        
+        # Only this block is lexed, strings and comments which
+        # started in an earlier block are known from its state.
+        text = unicode(text)
+        segments, state = scan_block(text, self.previousBlockState())
+        self.formatter.format(self.blockTokens(text, segments), None)
         
-        # Yes, re-highlight the whole document.
-        # There **must** be some optimizacion possibilities
-        # but it seems fast enough.
-        highlight(text,self.lexer,self.formatter)
+        # One call per run of characters sharing a style
+        for start, length, style in self.formatter.runs():
+            self.setFormat(start, length, style)
         
-        # Just apply the formatting to this block.
-        # For titles, it may be necessary to backtrack
-        # and format a couple of blocks **earlier**.
-        for i in range(len(unicode(text))):
-            try:
-                self.setFormat(i,1,self.formatter.data[p+i])
-            except IndexError:
-                pass
+        # The next block gets highlighted again when the state changes
+        self.setCurrentBlockState(state)
         
-        # I may need to do something about this being called
-        # too quickly.
+        # Used to find out whether we are called too quickly,
+        # see deferring()
         self.tstamp=time.time() 
 
+    def deferring(self, now):
+        """ True if the current block has to wait for the timer """
+        if self.document().characterCount()<self.LARGE_DOCUMENT:
+            return False
+        # Calls closer than a time slice belong to the same burst
+        if now-self.tstamp>self.TIME_SLICE:
+            self.sliceStart=now
+        return now-self.sliceStart>self.TIME_SLICE
+
+    def defer(self, number):
+        """ Leave a block to highlightPending. Its state is left
+        unchanged, so Qt doesn't go on with the next blocks.
+        """
+        if self.pendingFrom is None:
+            self.pendingFrom=self.pendingTo=number
+        else:
+            self.pendingFrom=min(self.pendingFrom, number)
+            self.pendingTo=max(self.pendingTo, number)
+        self.pendingBlockCount=self.document().blockCount()
+        
+        # Rapid edits are coalesced: wait for a pause
+        self.timer.start(self.DEBOUNCE_DELAY)
+
+    def highlightPending(self):
+        """ Highlight the deferred blocks, a time slice at a time """
+        if self.pendingFrom is None:
+            return
+        doc=self.document()
+        
+        # Lines added or removed meanwhile may have moved the last one
+        self.pendingTo+=abs(doc.blockCount()-self.pendingBlockCount)
+        number, last=self.pendingFrom, self.pendingTo
+        self.pendingFrom=self.pendingTo=None
+        
+        self.sliceStart=self.tstamp=time.time()
+        block=doc.findBlockByNumber(number)
+        while block.isValid() and number<=last:
+            if time.time()-self.sliceStart>self.TIME_SLICE:
+                # Let the event loop run, go on as soon as possible
+                self.defer(number)
+                self.pendingTo=max(self.pendingTo, last)
+                self.timer.start(0)
+                return
+            self.rehighlightBlock(block)
+            block=block.next()
+            number+=1
+
+    def blockTokens(self, text, segments):
+        """ (token type, value) pairs of a block, the lexer does the code """
+        for start, length, kind in segments:
+            value = text[start:start+length]
+            if kind == 'code':
+                for index, ttype, v in self.lexer.get_tokens_unprocessed(value):
+                    yield ttype, v
+            else:
+                yield SEGMENT_TOKENS[kind], value
+
 
 ## if __name__ == "__main__":
     ## app = QtGui.QApplication(sys.argv)
@@ -121,4 +221,4 @@ class Highlighter(QtGui.QSyntaxHighlighter):
     ## hl=Highlighter(python.document(),"python")
     ## python.show()
 
-    ## sys.exit(app.exec_())
\ No newline at end of file
+    ## sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Shows the plans of queries (EXPLAIN) as trees, before their layers are
+added, with the sequential scans on tables with a geometry column flagged.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+from PyQt4 import uic
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+
+import os
+
+
+class PlanInspector:
+    """ a dialog with the plans of ExplainWorker, exec_() returns True
+    when the user chose to add the layers """
+
+    NODE, RELATION, COST, ROWS, ACTUAL_TIME, ACTUAL_ROWS, DETAIL = range(7)
+
+    def __init__(self, plans, analyze=False, parent=None):
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.dialog = uic.loadUi(os.path.join(path, "ui_planinspector.ui"))
+        self.dialog.setParent(parent, self.dialog.windowFlags())
+        self.dialog.buttonBox.addButton("Add layer", QDialogButtonBox.AcceptRole)
+        self.analyze = analyze
+
+        tree = self.dialog.treePlan
+        if not analyze:
+            tree.hideColumn(self.ACTUAL_TIME)
+            tree.hideColumn(self.ACTUAL_ROWS)
+        scans = 0
+        for query, root in plans:
+            parent = tree.invisibleRootItem()
+            if len(plans) > 1:
+                # one top level item for each query of a batch
+                parent = QTreeWidgetItem(parent)
+                parent.setText(self.NODE, u" ".join(query.split())[:60])
+                parent.setToolTip(self.NODE, query)
+            self.addNode(parent, root)
+            scans += len([node for node in root.walk() if node.geometry_scan])
+        tree.expandAll()
+        for column in range(tree.columnCount()):
+            tree.resizeColumnToContents(column)
+
+        if scans:
+            self.dialog.labelSummary.setText(u"%d sequential scan(s) on tables with a geometry column: "
+                                             u"their spatial index isn't used, every row is read." % scans)
+        else:
+            self.dialog.labelSummary.setText(u"No sequential scan on tables with a geometry column.")
+
+    def addNode(self, parent, node):
+        item = QTreeWidgetItem(parent)
+        item.setText(self.NODE, node.name)
+        item.setText(self.RELATION, node.relation or u"")
+        item.setText(self.DETAIL, node.detail or u"")
+        item.setToolTip(self.DETAIL, node.detail or u"")
+        for column, value in ((self.COST, node.cost), (self.ROWS, node.rows),
+                              (self.ACTUAL_TIME, node.actual_time), (self.ACTUAL_ROWS, node.actual_rows)):
+            if value is not None:
+                item.setText(column, u"%g" % value)
+                item.setTextAlignment(column, Qt.AlignRight | Qt.AlignVCenter)
+        if node.loops is not None and node.loops > 1:
+            # actual time and rows are per loop
+            item.setToolTip(self.ACTUAL_TIME, u"x %d loops" % node.loops)
+            item.setToolTip(self.ACTUAL_ROWS, u"x %d loops" % node.loops)
+
+        if node.geometry_scan:
+            for column in range(self.DETAIL + 1):
+                item.setForeground(column, QBrush(Qt.red))
+            item.setToolTip(self.NODE, u"Sequential scan on a table with a geometry column")
+
+        for child in node.children:
+            self.addNode(item, child)
+        return item
+
+    def exec_(self):
+        return self.dialog.exec_() == QDialog.Accepted
@@ -23,12 +23,14 @@ from PyQt4 import uic
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 from qgis.core import *
+from qgis.gui import QgsMessageBar
 import DbConnection
-import highlighter as hl
+import timings
 import os
-import resources
+import time
 
-# Initialize Qt resources from file resources.py
+# The dock, the highlighter (pygments) and the connectors are only
+# imported when the dock is first shown, see initDock()
 
 conn = DbConnection.ConnectionManager()
 
@@ -36,34 +38,76 @@ class PostgisLayer:
     def __init__(self, iface):
         # Save reference to the QGIS interface
         self.iface = iface
+        # the QueryWorkers running the current queries, one per layer
+        self.workers = []
+        # created by the first show()
+        self.dock = None
+        # created when first used, see run()
+        self.queryCache = None
+        # the plans being computed, see explain(), and the ones to show
+        self.explainWorker = None
+        self.pendingPlans = None
+        # the queries run, see createDock(), and their panel
+        self.history = None
+        self.historyDock = None
     def initGui(self):
-        # Create action that will start plugin configuration
-        self.action = QAction(QIcon(":/plugins/postgislayer/icon.png"), "Fast SQL Layer", self.iface.mainWindow())
-        #Add toolbar button and menu item
-        self.iface.addPluginToDatabaseMenu("&Fast SQL Layer", self.action)
-        #self.iface.addToolBarIcon(self.action)
+        with timings.timed("initGui"):
+          path = os.path.dirname(os.path.abspath(__file__))
+          
+          # Create action that will start plugin configuration
+          self.action = QAction(QIcon(os.path.join(path, "icon.png")), "Fast SQL Layer", self.iface.mainWindow())
+          #Add toolbar button and menu item
+          self.iface.addPluginToDatabaseMenu("&Fast SQL Layer", self.action)
+          #self.iface.addToolBarIcon(self.action)
+          
+          #connect the action to the run method
+          QObject.connect(self.action, SIGNAL("triggered()"), self.show)
         
+    def initDock(self):
+        global hl, queryworker, querycache, queryhistory, sqltokenizer, planinspector
+        with timings.timed("initDock"):
+          with timings.timed("import highlighter"):
+            import highlighter as hl
+            import sqltokenizer
+          with timings.timed("import queryworker"):
+            import queryworker
+            import planinspector
+          with timings.timed("import querycache"):
+            import querycache
+            import queryhistory
+          self.createDock()
+        QgsMessageLog.logMessage("Start-up timings:\n" + timings.report(), "Fast SQL Layer")
         
+    def createDock(self):
         #load the form  
         path = os.path.dirname(os.path.abspath(__file__))
         self.dock = uic.loadUi(os.path.join(path, "ui_postgislayer.ui"))
-        self.iface.addDockWidget(Qt.BottomDockWidgetArea, self.dock)        
-        
         
-        #connect the action to the run method
-        QObject.connect(self.action, SIGNAL("triggered()"), self.show)
         QObject.connect(self.dock.buttonRun, SIGNAL('clicked()'), self.run)        
+        QObject.connect(self.dock.buttonCancel, SIGNAL('clicked()'), self.cancel)
         QObject.connect(self.dock.buttonGet, SIGNAL('clicked()'), self.get)
         QObject.connect(self.dock.buttonRefreshConnections, SIGNAL('clicked()'), self.refresh)
+        QObject.connect(self.dock.buttonHistory, SIGNAL('clicked()'), self.showHistory)
+        QObject.connect(self.dock.buttonCleanup, SIGNAL('clicked()'), self.cleanup)
+        
+        #the plan as estimated, or with the actual timings (the query runs)
+        explainMenu = QMenu(self.dock)
+        QObject.connect(explainMenu.addAction("Explain"), SIGNAL('triggered()'), lambda: self.explain(False))
+        QObject.connect(explainMenu.addAction("Explain Analyze"), SIGNAL('triggered()'), lambda: self.explain(True))
+        self.dock.buttonExplain.setMenu(explainMenu)
 
         # Set an icon on the refresh button
-        self.dock.buttonRefreshConnections.setIcon(QIcon(':/plugins/postgislayer/refresh.png'));
+        self.dock.buttonRefreshConnections.setIcon(QIcon(os.path.join(path, 'refresh.png')));
  
         # set a fixed font in the query editor, makes it easier to read
         self.dock.textQuery.document().setDefaultFont(QFont('Lucida Console', 9));
         
-        #populate the combo with connections
-        self.refresh()
+        #populate the combo with connections, the registry
+        #tells about the ones added or removed later on
+        self.actionsDb = {}
+        registry = conn.getRegistry()
+        QObject.connect(registry, SIGNAL("connectionsChanged(PyQt_PyObject, PyQt_PyObject)"), self.connectionsChanged)
+        self.connectionsChanged(registry.connections(), [])
         
         #populate the gid/id and the_geom/geom combos
         self.dock.uniqueCombo.addItem('id')
@@ -74,36 +118,106 @@ class PostgisLayer:
         #populate the replace layer_combo
         self.dock.layerCombo.addItem('add layer')
         self.dock.layerCombo.addItem('replace layer')
+        self.dock.layerCombo.addItem('materialize layer')
         
         #start the highlight engine
         self.higlight_text = hl.Highlighter(self.dock.textQuery.document(), "sql")
         
+        #show the elapsed time while a query runs
+        self.elapsedTimer = QTimer()
+        self.elapsedTimer.setInterval(100)
+        QObject.connect(self.elapsedTimer, SIGNAL('timeout()'), self.updateElapsed)
+        
+        #every query run is kept, with its timings
+        self.history = queryhistory.QueryHistory()
+        
     def show(self):
+        if self.dock is None:
+          self.initDock()
         self.iface.addDockWidget(Qt.BottomDockWidgetArea, self.dock)
     
     def unload(self):
         # Remove the plugin menu item and icon
         self.iface.removePluginDatabaseMenu("&Fast SQL Layer", self.action)
         #self.iface.removeToolBarIcon(self.action)
+        
+        # close the connections kept open between runs
+        for worker in self.workers:
+          worker.cancel()
+        for worker in self.workers:
+          worker.wait()
+        if self.explainWorker is not None:
+          self.explainWorker.cancel()
+          self.explainWorker.wait()
+        conn.closeAllPools()
+        if self.queryCache is not None:
+          self.queryCache.close()
+        if self.history is not None:
+          self.history.close()
    
     
     def refresh(self):
-      #(re)populate the combo with connections
-      actions = conn.getAvailableConnections()
-      self.actionsDb = {}
-      self.dock.comboConnections.clear()
-      for a in actions:
-        self.actionsDb[ unicode(a.text()) ] = a
-        self.dock.comboConnections.addItem(QIcon(':/plugins/postgislayer/' + a.getTypeName() + '.png'), a.text())
+      #read the connections again, connectionsChanged() gets the changes
+      conn.getRegistry().update(True)
+    
+    def connectionsChanged(self, added, removed):
+      #only the connections added or removed are updated in the combo.
+      #A PostGIS and a SpatiaLite connection may have the same name: the
+      #connections are (conntype, name), the item data of the combo
+      for a in removed:
+        key = (a.getTypeName(), unicode(a.text()))
+        if self.actionsDb.get(key) is a:
+          del self.actionsDb[key]
+          self.dock.comboConnections.removeItem(self.findConnection(key))
+      for a in added:
+        key = (a.getTypeName(), unicode(a.text()))
+        if key not in self.actionsDb:
+          self.dock.comboConnections.addItem(a.icon(), a.text(), key)
+        self.actionsDb[key] = a
+    
+    def findConnection(self, key):
+      #index of a (conntype, name) in the combo, -1 if it's not there
+      combo = self.dock.comboConnections
+      for index in range(combo.count()):
+        if combo.itemData(index) == key:
+          return index
+      return -1
+    
+    def currentConnection(self):
+      #(conntype, name) of the connection chosen in the combo
+      return self.dock.comboConnections.itemData(self.dock.comboConnections.currentIndex())
+    
+    def getPool(self, dados):
+      # connections come from a pool, they stay open for the next runs
+      if dados not in self.actionsDb:
+        return None
+      try:
+        return self.actionsDb[dados].getPool()
+      except ImportError, e:
+        # the connector is imported now, its driver may be missing
+        QMessageBox.warning(self.dock, "Fast SQL Layer", unicode(e))
+        return None
+    
+    def getQueries(self, query):
+      #every SELECT becomes a layer, the semicolons in strings,
+      #comments or $$ bodies don't split statements
+      tokenizer = sqltokenizer.SqlTokenizer()
+      statements = sqltokenizer.split_statements(query)
+      queries = [q for q in statements if tokenizer.is_query(q)]
+      if len(queries) < len(statements):
+        self.iface.messageBar().pushMessage("Fast SQL Layer", "%d statement(s) not returning rows were not run" % (len(statements) - len(queries)), QgsMessageBar.WARNING, 5)
+      return queries
     
     def run(self):
-      QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+      if self.workers or self.explainWorker is not None:
+        return
       
-      dados = str(self.dock.comboConnections.currentText())
-      self.db = self.actionsDb[dados].connect()
+      dados = self.currentConnection()
+      pool = self.getPool(dados)
+      if pool is None:
+        return
       uniqueFieldName = self.dock.uniqueCombo.currentText()
       geomFieldName = self.dock.geomCombo.currentText()
-      uri = self.db.getURI()
       query = unicode(self.dock.textQuery.toPlainText())
       
       #replace layer (not working)
@@ -116,19 +230,261 @@ class PostgisLayer:
         except: 
           pass
 
-      #lstrip() is needed to remove spaces in the first line.
-      query = query.lstrip()
-      query = query.replace(';','')
-      uri.setDataSource("", "(" + query + ")", geomFieldName, "", uniqueFieldName)
+      queries = self.getQueries(query)
+      if not queries:
+        return
       
+      # a table with a spatial index is created from the query,
+      # the layer doesn't depend on the cost of the query any more
+      materialize = self.dock.layerCombo.currentText() == 'materialize layer'
       
+      # opt-in: the result is kept in a table, the next runs reuse it.
+      # The cache also keeps track of the materialized tables
+      cache = None
+      if self.dock.checkCache.isChecked() or materialize:
+        if self.queryCache is None:
+          self.queryCache = querycache.QueryCache()
+        cache = self.queryCache
       
+      # each query runs and its layer gets validated in a worker thread,
+      # so a slow query doesn't freeze QGIS. The workers run at the same
+      # time, each one on a connection of the pool.
+      layerName = unicode(self.dock.txtName.displayText())
+      for i, q in enumerate(queries):
+        name = layerName if len(queries) == 1 else u"%s %d" % (layerName, i + 1)
+        worker = queryworker.QueryWorker(pool, q, name, geomFieldName, uniqueFieldName, cache, materialize)
+        QObject.connect(worker, SIGNAL("layerLoaded(PyQt_PyObject)"), self.layerLoaded)
+        QObject.connect(worker, SIGNAL("queryError(QString)"), lambda msg, name=name: self.queryError(msg, name))
+        QObject.connect(worker, SIGNAL("queryCancelled()"), self.queryCancelled)
+        QObject.connect(worker, SIGNAL("finished()"), lambda worker=worker: self.runFinished(worker))
+        if len(queries) == 1:
+          QObject.connect(worker, SIGNAL("columnsDetected(PyQt_PyObject, PyQt_PyObject, PyQt_PyObject)"), self.columnsDetected)
+        self.workers.append(worker)
+      
+      self.runConnection = dados
+      self.runStarted = time.time()
+      self.batchSize = len(queries)
+      self.dock.buttonRun.setEnabled(False)
+      self.dock.buttonCancel.setEnabled(True)
+      self.updateElapsed()
+      self.elapsedTimer.start()
+      for worker in self.workers:
+        worker.start()
+    
+    def layerTables(self):
+      #(schema, table) of the database layers of the project
+      tables = set()
+      for layer in QgsMapLayerRegistry.instance().mapLayers().values():
+        if layer.type() == QgsMapLayer.VectorLayer and layer.providerType() in ('postgres', 'spatialite'):
+          uri = QgsDataSourceURI(layer.source())
+          tables.add((unicode(uri.schema()), unicode(uri.table())))
+      return tables
+    
+    def cleanup(self):
+      #the materialized tables are only dropped when the user says so,
+      #the layers of other projects may use them
+      if self.workers or self.explainWorker is not None:
+        return
+      pool = self.getPool(self.currentConnection())
+      if pool is None:
+        return
+      if self.queryCache is None:
+        self.queryCache = querycache.QueryCache()
+      inUse = self.layerTables()
+      tables = [t for t in self.queryCache.materializedTables(pool.key) if tuple(t) not in inUse]
+      if not tables:
+        self.iface.messageBar().pushMessage("Fast SQL Layer", "No materialized table to drop", QgsMessageBar.INFO, 3)
+        return
+      names = u"\n".join([u"%s.%s" % (schema, table) if schema else table for schema, table in tables])
+      answer = QMessageBox.question(self.dock, "Fast SQL Layer",
+                                    u"Drop these %d materialized tables? The layers of this project don't use them, "
+                                    u"the layers of other projects may.\n\n%s" % (len(tables), names),
+                                    QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+      if answer != QMessageBox.Yes:
+        return
+      try:
+        db = pool.acquire()
+      except DbConnection.DbError, e:
+        QMessageBox.warning(self.dock, "Fast SQL Layer", unicode(e.msg))
+        return
       try:
-        vl = self.iface.addVectorLayer(uri.uri(), self.dock.txtName.displayText(), self.db.getProviderName())
-      except BaseException as ex:
-        QMessageBox.information(None, "DEBUG:", ex.strerror)
+        dropped = self.queryCache.dropMaterialized(db, pool.key, tables)
+      finally:
+        DbConnection.ConnectionManager.releaseConnection(db)
+      if len(dropped) < len(tables):
+        QMessageBox.warning(self.dock, "Fast SQL Layer", u"%d of the %d tables couldn't be dropped, they may be in use"
+                            % (len(tables) - len(dropped), len(tables)))
+      else:
+        self.iface.messageBar().pushMessage("Fast SQL Layer", "%d table(s) dropped" % len(dropped), QgsMessageBar.INFO, 3)
+    
+    def cancel(self):
+      if self.workers:
+        self.dock.labelStatus.setText("Cancelling...")
+        for worker in self.workers:
+          worker.cancel()
+      if self.explainWorker is not None:
+        self.dock.labelStatus.setText("Cancelling...")
+        self.explainWorker.cancel()
+    
+    def explain(self, analyze):
+      if self.workers or self.explainWorker is not None:
+        return
+      pool = self.getPool(self.currentConnection())
+      if pool is None:
+        return
+      queries = self.getQueries(unicode(self.dock.textQuery.toPlainText()))
+      if not queries:
+        return
       
-      QApplication.restoreOverrideCursor()
+      # EXPLAIN ANALYZE runs the queries, it's done in a worker thread too
+      self.explainWorker = queryworker.ExplainWorker(pool, queries, analyze)
+      QObject.connect(self.explainWorker, SIGNAL("planReady(PyQt_PyObject)"), lambda plans: self.planReady(plans, analyze))
+      QObject.connect(self.explainWorker, SIGNAL("queryError(QString)"), lambda msg: QMessageBox.warning(self.dock, "Fast SQL Layer", msg))
+      QObject.connect(self.explainWorker, SIGNAL("queryCancelled()"), self.queryCancelled)
+      QObject.connect(self.explainWorker, SIGNAL("finished()"), self.explainFinished)
+      self.dock.labelStatus.setText("Explaining...")
+      self.dock.buttonRun.setEnabled(False)
+      self.dock.buttonExplain.setEnabled(False)
+      self.dock.buttonCancel.setEnabled(True)
+      self.explainWorker.start()
+    
+    def explainFinished(self):
+      if self.explainWorker is None:
+        return
+      self.explainWorker.wait()
+      self.explainWorker = None
+      self.dock.labelStatus.setText("")
+      self.dock.buttonRun.setEnabled(True)
+      self.dock.buttonExplain.setEnabled(True)
+      self.dock.buttonCancel.setEnabled(False)
+      if self.pendingPlans is not None:
+        # the dialog is shown once the buttons are back
+        plans, analyze = self.pendingPlans
+        self.pendingPlans = None
+        if planinspector.PlanInspector(plans, analyze, self.dock).exec_():
+          self.run()
+    
+    def planReady(self, plans, analyze):
+      self.pendingPlans = (plans, analyze)
+    
+    def updateElapsed(self):
+      if self.workers:
+        self.dock.labelStatus.setText("Running %d... %.1f s" % (len(self.workers), time.time() - self.runStarted))
+    
+    def layerLoaded(self, layer):
+      QgsMapLayerRegistry.instance().addMapLayer(layer)
+    
+    def columnsDetected(self, columns, geom, key):
+      #fill the combos with the columns of the result, the likely ones first
+      geoms = [name for name, kind in columns if kind == 'geometry']
+      keys = [name for name, kind in columns if kind == 'integer']
+      others = [name for name, kind in columns if kind is None]
+      for combo, names, picked in ((self.dock.geomCombo, geoms, geom), (self.dock.uniqueCombo, keys, key)):
+        combo.clear()
+        combo.addItems(names + others)
+        #no unique column: the provider numbers the features
+        combo.setEditText(picked or "")
+    
+    def queryError(self, msg, name):
+      if self.batchSize > 1:
+        # not a dialog for each of the layers of a batch
+        self.iface.messageBar().pushMessage("Fast SQL Layer", u"%s: %s" % (name, msg), QgsMessageBar.WARNING)
+      else:
+        QMessageBox.warning(self.dock, "Fast SQL Layer", msg)
+    
+    def queryCancelled(self):
+      self.iface.messageBar().pushMessage("Fast SQL Layer", "Query cancelled", QgsMessageBar.INFO, 3)
+    
+    def runFinished(self, worker):
+      if worker in self.workers:
+        worker.wait()
+        self.workers.remove(worker)
+        self.history.add(self.runConnection, worker.query, worker.elapsed(), worker.rows,
+                         worker.uniqueFieldName, worker.geomFieldName, worker.error)
+        if self.historyDock is not None:
+          self.fillHistory()
+      if self.workers:
+        return
+      self.elapsedTimer.stop()
+      self.dock.labelStatus.setText("%.1f s" % (time.time() - self.runStarted))
+      self.dock.buttonRun.setEnabled(True)
+      self.dock.buttonCancel.setEnabled(False)
+    
+    def showHistory(self):
+      if self.historyDock is None:
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.historyDock = uic.loadUi(os.path.join(path, "ui_queryhistory.ui"))
+        QObject.connect(self.historyDock.buttonRerun, SIGNAL('clicked()'), self.rerun)
+        QObject.connect(self.historyDock.buttonSlowest, SIGNAL('clicked()'), self.slowestFirst)
+        QObject.connect(self.historyDock.buttonClear, SIGNAL('clicked()'), self.clearHistory)
+        QObject.connect(self.historyDock.tableHistory, SIGNAL('itemDoubleClicked(QTableWidgetItem*)'), self.rerun)
+        self.iface.addDockWidget(Qt.BottomDockWidgetArea, self.historyDock)
+        self.iface.mainWindow().tabifyDockWidget(self.dock, self.historyDock)
+        self.fillHistory()
+      self.historyDock.show()
+      self.historyDock.raise_()
+    
+    def fillHistory(self):
+      table = self.historyDock.tableHistory
+      #no sorting while the rows are added, the sort column is kept
+      table.setSortingEnabled(False)
+      entries = self.history.entries()
+      table.setRowCount(len(entries))
+      for row, entry in enumerate(entries):
+        #the times and counts are numbers, so that they sort as numbers
+        when = QTableWidgetItem(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry.time)))
+        when.setData(Qt.UserRole, entry.id)
+        wallTime = QTableWidgetItem()
+        wallTime.setData(Qt.DisplayRole, round(entry.wall_time, 3))
+        rows = QTableWidgetItem()
+        if entry.rows is not None:
+          rows.setData(Qt.DisplayRole, entry.rows)
+        result = QTableWidgetItem(u"ok" if entry.success else entry.error)
+        query = QTableWidgetItem(u" ".join(entry.query.split()))
+        query.setToolTip(entry.query)
+        connection = QTableWidgetItem(entry.connection)
+        if entry.conntype is not None:
+          connection.setToolTip(u"%s (%s)" % (entry.connection, entry.conntype))
+        items = (when, connection, wallTime, rows,
+                 QTableWidgetItem(entry.key or u""), QTableWidgetItem(entry.geom or u""), result, query)
+        for column, item in enumerate(items):
+          table.setItem(row, column, item)
+      table.setSortingEnabled(True)
+      table.resizeColumnsToContents()
+    
+    def slowestFirst(self):
+      self.historyDock.tableHistory.sortItems(2, Qt.DescendingOrder)
+    
+    def clearHistory(self):
+      self.history.clear()
+      self.fillHistory()
+    
+    def rerun(self, *args):
+      #the query of the selected entry goes back to the editor and runs,
+      #on the same connection and with the same columns
+      table = self.historyDock.tableHistory
+      row = table.currentRow()
+      if row < 0 or self.workers or self.explainWorker is not None:
+        return
+      entry = self.history.get(table.item(row, 0).data(Qt.UserRole))
+      if entry is None:
+        return
+      #older entries only have the name: the chosen connection is kept if it has it
+      if entry.conntype is not None:
+        index = self.findConnection((entry.conntype, entry.connection))
+      elif self.dock.comboConnections.currentText() == entry.connection:
+        index = self.dock.comboConnections.currentIndex()
+      else:
+        index = self.dock.comboConnections.findText(entry.connection)
+      if index != self.dock.comboConnections.currentIndex():
+        if index < 0:
+          QMessageBox.warning(self.dock, "Fast SQL Layer", u"The connection %s doesn't exist any more" % entry.connection)
+          return
+        self.dock.comboConnections.setCurrentIndex(index)
+      self.dock.textQuery.setPlainText(entry.query)
+      self.dock.uniqueCombo.setEditText(entry.key)
+      self.dock.geomCombo.setEditText(entry.geom)
+      self.run()
     
     def get(self):
         layer = self.iface.activeLayer()
@@ -146,7 +502,7 @@ class PostgisLayer:
             iStart = uri2.find(sStartKey)
             if iStart > 0:
               iEnd = uri2.find(')" (', iStart)
-              sql = uri2[iStart + len(sStartKey):iEnd]
+              sql = uri2[iStart + len(sStartKey):iEnd].rstrip('\n')
               sql = sql.decode('unicode_escape') 
               self.dock.textQuery.setPlainText(sql)
             else:
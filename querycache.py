@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Keeps the results of queries in tables, so that running a query again
+gives a layer on the stored copy instead of making the server run it
+again.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+from qgis.core import QgsApplication, QgsMessageLog
+
+import DbConnection
+from sqltokenizer import SqlTokenizer, KEYWORD, TEXT
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+def normalize(query):
+    """ the query without comments, with single spaces and upper case
+    keywords, so that formatting changes give the same fingerprint """
+    parts = []
+    for index, ttype, value in SqlTokenizer().get_tokens_unprocessed(query):
+        if ttype.startswith('Token.Comment') or ttype == TEXT:
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        elif ttype == KEYWORD:
+            parts.append(value.upper())
+        else:
+            parts.append(value)
+    return ''.join(parts).strip(' ;')
+
+
+# e.g. password='se\'cret' in QgsDataSourceURI.connectionInfo()
+PASSWORD = re.compile(r"\s*password=(?:'(?:[^'\\]|\\.)*'|\S*)")
+
+
+def connection_name(connection):
+    """ text of a connection key, see DbConnection.ConnectionManager.getPool.
+    The password is left out: the text is written to the cache index """
+    conntype, name, info = connection
+    return u"|".join([unicode(conntype), unicode(name), PASSWORD.sub(u"", unicode(info)).strip()])
+
+
+def fingerprint(connection, query):
+    """ sha1 of the connection key and the normalized query """
+    text = u"%s\n%s" % (connection_name(connection), normalize(query))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class QueryCache:
+    """ the results of queries, materialized in tables.
+
+    PostGIS results are unlogged tables in 'schema' on the server,
+    SpatiaLite ones are tables of the database queried, with their
+    geometry column registered and a spatial index, see supports().
+    The index of the cached results is a local database (the file at
+    'path').
+
+    A result is used for 'ttl' seconds. For each connection no more than
+    'max_tables' results, 'max_rows' rows and 'max_bytes' bytes (PostGIS)
+    are kept, the least recently used results are dropped first.
+
+    A PostGIS connection whose user may not create the cache schema or
+    its tables isn't cached any more (until QGIS restarts), its layers
+    are on the queries themselves.
+    """
+
+    # SQLSTATE of the errors of a user lacking the CREATE privilege
+    INSUFFICIENT_PRIVILEGE = '42501'
+
+    def __init__(self, path=None, schema='fsl_cache', ttl=3600, max_tables=50,
+                 max_rows=10000000, max_bytes=1024 * 1024 * 1024):
+        if path is None:
+            path = os.path.join(unicode(QgsApplication.qgisSettingsDirPath()), 'fastsqllayer_cache.sqlite')
+        self.path = path
+        self.schema = schema
+        self.ttl = ttl
+        self.max_tables = max_tables
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        # connection_name() of the connections which can't be cached
+        self.disabled = set()
+
+        # the index is used by the query workers, one at a time
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS query_cache (
+            fingerprint TEXT PRIMARY KEY, connection TEXT, query TEXT,
+            schema_name TEXT, table_name TEXT,
+            created REAL, used REAL, rows INTEGER, bytes INTEGER)""")
+        # the tables of the materialized layers, see addMaterialized()
+        self.con.execute("""CREATE TABLE IF NOT EXISTS materialized (
+            connection TEXT, schema_name TEXT, table_name TEXT, created REAL,
+            PRIMARY KEY (connection, schema_name, table_name))""")
+        # indexes written before the passwords were left out
+        for (connection,) in self.con.execute("SELECT DISTINCT connection FROM query_cache WHERE connection LIKE '%password=%'").fetchall():
+            self.con.execute("UPDATE query_cache SET connection = ? WHERE connection = ?",
+                             (PASSWORD.sub(u"", connection).strip(), connection))
+        self.con.commit()
+
+    def getURI(self, db, connection, query, geomFieldName, uniqueFieldName):
+        """ the URI of a layer on the cached result of the query, which is
+        run and stored first if needed. connection is the key of the pool
+        db comes from. None if the result can't be stored (no privilege).
+        Runs in a query worker. """
+        key = fingerprint(connection, query)
+        entry = self.lookup(db, key)
+        if entry is None:
+            try:
+                entry = self.store(db, connection, key, query, geomFieldName)
+            except DbConnection.DbError, e:
+                if e.code != self.INSUFFICIENT_PRIVILEGE:
+                    raise
+                self.disabled.add(connection_name(connection))
+                QgsMessageLog.logMessage(u"Results of %s not cached: %s" % (connection[1], e.msg), "Fast SQL Layer")
+                return None
+        schema, table = entry
+
+        uri = db.getURI()
+        uri.setDataSource(schema or "", table, geomFieldName, "", uniqueFieldName)
+        return uri
+
+    def supports(self, db):
+        """ whether the results of db can be cached: a SpatiaLite layer
+        needs the spatial metadata tables of its database, the PostGIS
+        user the privilege to create tables, see getURI() """
+        pool = getattr(db, 'pool', None)
+        if pool is not None and connection_name(pool.key) in self.disabled:
+            return False
+        return db.getTypeName() != 'spatialite' or db.has_geometry_columns
+
+    def lookup(self, db, key):
+        """ (schema, table) of a valid cached result, None if there is none """
+        self.lock.acquire()
+        try:
+            row = self.con.execute("SELECT schema_name, table_name, created FROM query_cache WHERE fingerprint = ?",
+                                   (key,)).fetchone()
+        finally:
+            self.lock.release()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+
+        # the table may have been dropped by someone else
+        schema, table = row[:2]
+        if not self.tableExists(db, schema, table):
+            self.forget(key)
+            return None
+
+        self.lock.acquire()
+        try:
+            self.con.execute("UPDATE query_cache SET used = ? WHERE fingerprint = ?", (time.time(), key))
+            self.con.commit()
+        finally:
+            self.lock.release()
+        return schema, table
+
+    def store(self, db, connection, key, query, geomFieldName):
+        """ run the query into a new table, returns its (schema, table) """
+        table = "fsl_%s" % key
+
+        if db.getTypeName() == 'spatialite':
+            # an expired result, or one this cache doesn't know about
+            self.dropTable(db, None, table)
+            # the geometry column gets registered, for the provider
+            schema, table = db.materialize(table, query, geomFieldName)
+            rows, size = db.get_table_rows(table), None
+        else:
+            self.dropTable(db, self.schema, table)
+            # not from the cached list of schemas: another connection
+            # of the pool may just have created it
+            schema = self.schema
+            db.create_schema(schema, if_not_exists=True)
+            rows = db.create_table_as(table, query, schema, unlogged=True)
+            size = db.get_table_size(table, schema)
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.con.execute("INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, connection_name(connection), query, schema, table, now, now, rows, size))
+            self.con.commit()
+        finally:
+            self.lock.release()
+
+        self.evict(db, connection, key)
+        return schema, table
+
+    def evict(self, db, connection, keep=None):
+        """ drop the expired results of a connection, then the least recently
+        used ones until the limits are respected. 'keep' is a result in use """
+        self.lock.acquire()
+        try:
+            entries = self.con.execute("""SELECT fingerprint, schema_name, table_name, created, rows, bytes
+                FROM query_cache WHERE connection = ? ORDER BY used DESC""",
+                (connection_name(connection),)).fetchall()
+        finally:
+            self.lock.release()
+
+        now = time.time()
+        tables = rows = size = 0
+        for key, schema, table, created, r, b in entries:
+            tables += 1
+            rows += r or 0
+            size += b or 0
+            if key == keep:
+                continue
+            if (now - created > self.ttl or tables > self.max_tables
+                    or rows > self.max_rows or size > self.max_bytes):
+                if self.dropTable(db, schema, table):
+                    self.forget(key)
+
+    def clear(self, db, connection):
+        """ drop all the results of a connection """
+        self.lock.acquire()
+        try:
+            entries = self.con.execute("SELECT fingerprint, schema_name, table_name FROM query_cache WHERE connection = ?",
+                                       (connection_name(connection),)).fetchall()
+        finally:
+            self.lock.release()
+        for key, schema, table in entries:
+            if self.dropTable(db, schema, table):
+                self.forget(key)
+
+    def addMaterialized(self, connection, schema, table):
+        """ keep track of the table of a materialized layer """
+        self.lock.acquire()
+        try:
+            self.con.execute("INSERT OR REPLACE INTO materialized VALUES (?, ?, ?, ?)",
+                             (connection_name(connection), schema or "", table, time.time()))
+            self.con.commit()
+        finally:
+            self.lock.release()
+
+    def materializedTables(self, connection):
+        """ (schema, table) of the materialized layers of a connection, the
+        oldest first. schema is "" for SpatiaLite """
+        self.lock.acquire()
+        try:
+            return self.con.execute("SELECT schema_name, table_name FROM materialized WHERE connection = ? ORDER BY created",
+                                    (connection_name(connection),)).fetchall()
+        finally:
+            self.lock.release()
+
+    def dropMaterialized(self, db, connection, tables):
+        """ drop tables of the materialized layers of a connection, a list of
+        (schema, table) the user chose, see materializedTables(). Returns the
+        ones dropped """
+        dropped = []
+        for schema, table in tables:
+            if self.dropTable(db, schema or None, table):
+                dropped.append((schema, table))
+                self.lock.acquire()
+                try:
+                    self.con.execute("DELETE FROM materialized WHERE connection = ? AND schema_name = ? AND table_name = ?",
+                                     (connection_name(connection), schema, table))
+                    self.con.commit()
+                finally:
+                    self.lock.release()
+        return dropped
+
+    def forget(self, key):
+        self.lock.acquire()
+        try:
+            self.con.execute("DELETE FROM query_cache WHERE fingerprint = ?", (key,))
+            self.con.commit()
+        finally:
+            self.lock.release()
+
+    def tableExists(self, db, schema, table):
+        name = u'"%s"."%s"' % (schema, table) if schema else u'"%s"' % table
+        try:
+            db.check_query(u'SELECT 1 FROM %s' % name)
+        except DbConnection.DbError:
+            return False
+        return True
+
+    def dropTable(self, db, schema, table):
+        """ returns False if the table couldn't be dropped (e.g. it's in use) """
+        try:
+            if not self.tableExists(db, schema, table):
+                pass
+            elif db.getTypeName() == 'spatialite':
+                db.delete_geometry_table(table)
+            else:
+                db.delete_table(table, schema)
+        except DbConnection.DbError:
+            return False
+        return True
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Keeps the queries which were run, with their timings, in a SQLite file
+next to the QGIS settings.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+from qgis.core import QgsApplication
+
+from querycache import normalize
+
+import os
+import sqlite3
+import time
+
+
+class HistoryEntry:
+    """ a query which was run, see QueryHistory.entries(). connection is the
+    name of the connection, conntype its type (None in older histories) """
+
+    COLUMNS = "id, time, conntype, connection, query, wall_time, rows, key, geom, success, error"
+
+    def __init__(self, row):
+        (self.id, self.time, self.conntype, self.connection, self.query, self.wall_time, self.rows,
+         self.key, self.geom, self.success, self.error) = row
+
+
+class QueryHistory:
+    """ the queries run, the last 'max_entries' of them are kept """
+
+    def __init__(self, path=None, max_entries=1000):
+        if path is None:
+            path = os.path.join(unicode(QgsApplication.qgisSettingsDirPath()), 'fastsqllayer_history.sqlite')
+        self.path = path
+        self.max_entries = max_entries
+
+        self.con = sqlite3.connect(path)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, conntype TEXT, connection TEXT, query TEXT,
+            wall_time REAL, rows INTEGER, key TEXT, geom TEXT, success INTEGER, error TEXT)""")
+        self.con.execute("CREATE INDEX IF NOT EXISTS history_wall_time ON history (wall_time)")
+        # histories written before the type of the connection was kept:
+        # two connections of different types may have the same name
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(history)")]
+        if 'conntype' not in columns:
+            self.con.execute("ALTER TABLE history ADD COLUMN conntype TEXT")
+        self.con.commit()
+
+    def add(self, connection, query, wall_time, rows=None, key=None, geom=None, error=None):
+        """ record a run on connection, a (conntype, name), error is None if
+        it succeeded. The oldest entries are dropped beyond max_entries """
+        conntype, name = connection
+        self.con.execute("""INSERT INTO history (time, conntype, connection, query, wall_time, rows, key, geom, success, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (time.time(), conntype, name, normalize(query), wall_time, rows, key, geom, error is None, error))
+        self.con.execute("DELETE FROM history WHERE id <= (SELECT max(id) FROM history) - ?", (self.max_entries,))
+        self.con.commit()
+
+    def entries(self, by_latency=False, limit=None):
+        """ the entries, the last ones first, or the slowest ones first """
+        sql = "SELECT %s FROM history ORDER BY %s" % (HistoryEntry.COLUMNS, "wall_time DESC" if by_latency else "id DESC")
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        return [HistoryEntry(row) for row in self.con.execute(sql)]
+
+    def get(self, entry_id):
+        row = self.con.execute("SELECT %s FROM history WHERE id = ?" % HistoryEntry.COLUMNS, (entry_id,)).fetchone()
+        return HistoryEntry(row) if row is not None else None
+
+    def clear(self):
+        self.con.execute("DELETE FROM history")
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Builds the layer of a query without the dock: the data source URI or a
+QgsVectorLayer, from the name of a saved connection and the SQL. The
+module is imported from the package of the plugin (its directory in the
+QGIS plugins folder, fastsqllayer when installed from the repository):
+
+    from fastsqllayer import querylayer
+    layer = querylayer.get_layer("my database", "SELECT gid, geom FROM parcels", "parcels")
+    QgsMapLayerRegistry.instance().addMapLayer(layer)
+
+Only the connectors are imported (when first used), not the dock, the
+highlighter nor the resources, so that scripts and processing models can
+create many layers quickly.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+from PyQt4.QtCore import QSettings
+from qgis.core import QGis, QgsRectangle, QgsVectorLayer
+
+import DbConnection
+import querycache
+
+import re
+import time
+import uuid
+
+# extent, count, geometry type and srid of the layers, by fingerprint
+# of their source, so that they are computed once
+METADATA_CACHE = DbConnection.CatalogCache(ttl=3600, maxsize=128)
+
+# the 2D and 3D types of the geometry types, QGIS 2 has no M geometries
+WKB_TYPES = {
+    'POINT': (QGis.WKBPoint, QGis.WKBPoint25D),
+    'LINESTRING': (QGis.WKBLineString, QGis.WKBLineString25D),
+    'POLYGON': (QGis.WKBPolygon, QGis.WKBPolygon25D),
+    'MULTIPOINT': (QGis.WKBMultiPoint, QGis.WKBMultiPoint25D),
+    'MULTILINESTRING': (QGis.WKBMultiLineString, QGis.WKBMultiLineString25D),
+    'MULTIPOLYGON': (QGis.WKBMultiPolygon, QGis.WKBMultiPolygon25D),
+}
+
+# e.g. POINT, ST_MultiPolygon, POINTZ, "POINT ZM" without the spaces
+GEOMETRY_TYPE = re.compile(r'^(?:ST_)?((?:MULTI)?(?:POINT|LINESTRING|POLYGON))(ZM|Z|M)?$')
+
+# the base types of the WKB codes
+WKB_CODES = {1: 'POINT', 2: 'LINESTRING', 3: 'POLYGON', 4: 'MULTIPOINT', 5: 'MULTILINESTRING', 6: 'MULTIPOLYGON'}
+
+# flags of the EWKB codes
+EWKB_Z, EWKB_M, EWKB_SRID = 0x80000000, 0x40000000, 0x20000000
+
+
+def wkb_type(geom_type):
+    """ the QGis.WkbType of a geometry type, a name (e.g. 'POINT', 'POINT Z',
+    'MULTIPOLYGONM') or a WKB code (ISO: 1001 is a POINT Z, EWKB: with the Z,
+    M and SRID flags). The M values are left out. None if it's unknown """
+    if geom_type is None:
+        return None
+    if isinstance(geom_type, (int, long)):
+        z = bool(geom_type & EWKB_Z)
+        code = geom_type & ~(EWKB_Z | EWKB_M | EWKB_SRID)
+        # 1000: Z, 2000: M, 3000: ZM
+        z = z or code // 1000 in (1, 3)
+        name = WKB_CODES.get(code % 1000)
+    else:
+        m = GEOMETRY_TYPE.match(unicode(geom_type).upper().replace(' ', ''))
+        if m is None:
+            return None
+        name = m.group(1)
+        z = m.group(2) in ('Z', 'ZM')
+    if name not in WKB_TYPES:
+        return None
+    return WKB_TYPES[name][1 if z else 0]
+
+
+class QueryLayer:
+    """ the steps building the layer of a query on a connection (db).
+
+    geom and key are the geometry and unique columns wanted, the ones
+    of the result are picked by detectColumns(). With a QueryCache the
+    layer is on the cached result of the query, with materialize=True on
+    a new table with a spatial index, in MATERIALIZE_SCHEMA. The cache
+    keeps track of those tables, they are only dropped when the user asks
+    for it (see QueryCache.dropMaterialized): another project may use them.
+    """
+
+    MATERIALIZE_SCHEMA = 'fsl_layers'
+
+    def __init__(self, db, query, name="querylayer", geom=None, key=None, cache=None, materialize=False):
+        self.db = db
+        self.query = query
+        self.name = name
+        self.geom = geom
+        self.key = key
+        self.cache = cache
+        self.materialize = materialize
+
+    def detectColumns(self):
+        """ (name, kind) of the columns of the result, the geometry and unique
+        columns are picked among them. It's also where a wrong query fails,
+        with a readable message. """
+        columns = self.db.get_query_columns(self.query)
+        self.geom, self.key = self.db.pick_layer_columns(columns, self.geom, self.key)
+        return columns
+
+    def checkColumns(self):
+        if self.geom is None:
+            raise DbConnection.DbError(u"The query returns no geometry column")
+        if self.key is None and self.isSubquery() and self.db.getTypeName() == 'postgis':
+            # the PostGIS provider reads the tables of materialized and
+            # cached results by ctid, a subquery has no such column
+            raise DbConnection.DbError(u"The query returns no unique key column; add one or pick one")
+
+    def isSubquery(self):
+        """ whether the layer is on the query itself, not on a table """
+        return not self.materialize and not (self.cache is not None and self.cache.supports(self.db))
+
+    def dataSourceURI(self):
+        if self.materialize:
+            # the provider reads a table: panning uses the spatial index
+            # instead of running the query again
+            schema, table = self.db.materialize(self.materializedTableName(), self.query, self.geom,
+                                                self.MATERIALIZE_SCHEMA)
+            if self.cache is not None:
+                self.cache.addMaterialized(self.db.pool.key, schema, table)
+            uri = self.db.getURI()
+            uri.setDataSource(schema, table, self.geom, "", self.key or "")
+            return uri
+        if not self.isSubquery():
+            # the query runs (once) into a table, the layer is on that table
+            uri = self.cache.getURI(self.db, self.db.pool.key, self.query, self.geom, self.key or "")
+            if uri is not None:
+                return uri
+            # it can't be stored: the layer is on the query, which
+            # needs a unique column
+            self.checkColumns()
+        # the newline ends a -- comment at the end of the query
+        uri = self.db.getURI()
+        uri.setDataSource("", "(" + self.query + "\n)", self.geom, "", self.key or "")
+        return uri
+
+    def metadata(self, uri):
+        """ extent, feature count, geometry type and srid of the layer's source,
+        computed once per source. None if they can't be computed """
+        schema, table = unicode(uri.schema()), unicode(uri.table())
+        source = self.query if table.startswith('(') else u"%s.%s" % (schema, table)
+        key = (querycache.fingerprint(self.db.pool.key, source), self.geom)
+        found, metadata = METADATA_CACHE.get(key)
+        if found:
+            return metadata
+
+        try:
+            if table.startswith('('):
+                metadata = self.db.get_query_metadata(self.query, self.geom)
+            else:
+                # analyzed tables have estimates of the extent and count
+                metadata = self.db.get_table_metadata(table, self.geom, schema)
+        except DbConnection.DbError, e:
+            # the provider will do without
+            return None
+        METADATA_CACHE.put(key, metadata)
+        return metadata
+
+    def applyMetadata(self, uri, metadata):
+        """ what the provider would find out scanning the whole result """
+        uri.setUseEstimatedMetadata(True)
+        if metadata['srid'] is not None:
+            uri.setSrid(str(metadata['srid']))
+        wkbType = wkb_type(metadata['type'])
+        if wkbType is not None:
+            uri.setWkbType(wkbType)
+
+    def layer(self, uri, metadata=None):
+        layer = QgsVectorLayer(uri.uri(), self.name, self.db.getProviderName())
+        if metadata is not None and metadata['extent'] is not None and layer.isValid():
+            layer.setExtent(QgsRectangle(*metadata['extent']))
+        return layer
+
+    def materializedTableName(self):
+        """ a new table name, from the layer name. The random suffix keeps the
+        layers of a batch (same name and second) from getting the same table,
+        the name fits in the 63 characters of a PostgreSQL identifier """
+        name = re.sub(r'\W+', '_', unicode(self.name).lower()).strip('_') or 'querylayer'
+        return "%s_%s_%s" % (name[:38], time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+
+
+def connection_type(connection):
+    """ the type (e.g. 'postgis') of the saved connection called 'connection' """
+    settings = QSettings()
+    for conntype in DbConnection.ConnectionManager.SUPPORTED_CONNECTORS:
+        settings.beginGroup(u"/%s/connections" % DbConnection.ConnectionManager.getSettingsKey(conntype))
+        found = connection in settings.childGroups()
+        settings.endGroup()
+        if found:
+            return conntype
+    raise DbConnection.DbError(u'there is no defined database connection "%s".' % connection)
+
+
+def get_pool(connection, conntype=None, parent=None, interactive=False):
+    """ the pool of the saved connection, see DbConnection.ConnectionManager.getPool.
+    The password is asked (parent is the dialog's parent) only if interactive,
+    otherwise a password which isn't saved raises DbError """
+    if conntype is None:
+        conntype = connection_type(connection)
+    pool = DbConnection.ConnectionManager.getPool(conntype, connection, parent, interactive)
+    if pool is None:
+        raise DbConnection.DbError(u'no password given for connection "%s".' % connection)
+    return pool
+
+
+def build(connection, query, name="querylayer", geom=None, key=None, conntype=None,
+          cache=None, materialize=False, metadata=False, parent=None, interactive=False):
+    """ (QueryLayer, QgsDataSourceURI, metadata) of a query on a saved connection.
+    geom and key are found among the columns of the result when they aren't
+    given. With metadata=True the query is scanned once beforehand for the
+    extent and the feature count, so the provider doesn't have to (it's
+    worth it for a layer which is going to be drawn, not when many layers
+    are created). Raises DbError. """
+    pool = get_pool(connection, conntype, parent, interactive)
+    db = pool.acquire()
+    try:
+        builder = QueryLayer(db, query, name, geom, key, cache, materialize)
+        builder.detectColumns()
+        builder.checkColumns()
+        uri = builder.dataSourceURI()
+        found = builder.metadata(uri) if metadata else None
+        if found is not None:
+            builder.applyMetadata(uri, found)
+        return builder, uri, found
+    finally:
+        DbConnection.ConnectionManager.releaseConnection(db)
+
+
+def get_uri(connection, query, geom=None, key=None, conntype=None, cache=None, materialize=False,
+            metadata=False, parent=None, interactive=False):
+    """ the data source URI of the layer of a query, see build() """
+    return build(connection, query, geom=geom, key=key, conntype=conntype, cache=cache,
+                 materialize=materialize, metadata=metadata, parent=parent, interactive=interactive)[1]
+
+
+def get_layer(connection, query, name="querylayer", geom=None, key=None, conntype=None,
+              cache=None, materialize=False, metadata=False, parent=None, interactive=False):
+    """ the layer of a query, see build(). Check layer.isValid() """
+    builder, uri, found = build(connection, query, name, geom, key, conntype, cache,
+                                materialize, metadata, parent, interactive)
+    return builder.layer(uri, found)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Runs a query and builds its layer outside of the QGIS GUI thread.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from qgis.core import *
+
+import DbConnection
+import querylayer
+import time
+
+
+def error_message(e):
+    """ the message of an unexpected exception, with its class """
+    try:
+        msg = unicode(e)
+    except UnicodeError:
+        msg = str(e).decode('utf-8', 'replace')
+    return u"%s: %s" % (e.__class__.__name__, msg)
+
+
+class QueryWorker(QThread):
+    """ Checks a query on a pooled connection and creates its layer.
+
+    Emits layerLoaded(PyQt_PyObject) with a valid layer, queryError(QString)
+    when the query or the layer fail and queryCancelled() after cancel().
+    columnsDetected(PyQt_PyObject, PyQt_PyObject, PyQt_PyObject) gives the
+    (name, kind) columns of the result and the geometry and unique columns
+    picked among them.
+    With a QueryCache the layer is built on the cached result of the query,
+    with materialize=True on a new table with a spatial index. The layer is
+    built by querylayer.QueryLayer, the worker checks for cancel() between
+    its steps.
+    """
+
+    # in a batch the workers may wait long for a connection of the pool
+    ACQUIRE_TIMEOUT = 3600
+
+    def __init__(self, pool, query, layerName, geomFieldName, uniqueFieldName, cache=None,
+                 materialize=False, parent=None):
+        QThread.__init__(self, parent)
+        self.pool = pool
+        self.query = query
+        self.layerName = layerName
+        self.geomFieldName = unicode(geomFieldName)
+        self.uniqueFieldName = unicode(uniqueFieldName)
+        self.cache = cache
+        self.materialize = materialize
+
+        self.db = None
+        self.cancelled = False
+        self.startTime = None
+        self.endTime = None
+
+        # known once finished: the (estimated) feature count and
+        # the error message, None if the layer was loaded
+        self.rows = None
+        self.error = None
+
+    def elapsed(self):
+        """ seconds since the worker started, until it finished """
+        if self.startTime is None:
+            return 0.0
+        return (self.endTime or time.time()) - self.startTime
+
+    def cancel(self):
+        """ abort the query server-side, the layer (if any) is thrown away """
+        self.cancelled = True
+        db = self.db
+        if db is not None:
+            db.cancel()
+
+    def run(self):
+        self.startTime = time.time()
+        try:
+            try:
+                self.runQuery()
+            except Exception, e:
+                # not a database error: the run failed all the same,
+                # it mustn't look like a success (e.g. in the history)
+                self.fail(error_message(e))
+        finally:
+            self.endTime = time.time()
+
+    def fail(self, msg):
+        self.error = msg
+        self.emit(SIGNAL("queryError(QString)"), msg)
+
+    def abort(self):
+        self.error = u"cancelled"
+        self.emit(SIGNAL("queryCancelled()"))
+
+    def runQuery(self):
+        try:
+            self.db = self.pool.acquire(self.ACQUIRE_TIMEOUT)
+        except DbConnection.DbError, e:
+            self.fail(unicode(e.msg))
+            return
+        if self.cancelled:
+            # cancelled while waiting for the connection
+            DbConnection.ConnectionManager.releaseConnection(self.db)
+            self.db = None
+            self.abort()
+            return
+
+        try:
+            try:
+                layer = self.loadLayer()
+            except DbConnection.DbError, e:
+                if self.cancelled:
+                    self.abort()
+                else:
+                    self.fail(unicode(e.msg))
+                return
+        finally:
+            db, self.db = self.db, None
+            DbConnection.ConnectionManager.releaseConnection(db)
+
+        if self.cancelled:
+            self.abort()
+        elif not layer.isValid():
+            self.fail(u"The layer is not valid, check the unique and geometry columns")
+        else:
+            # the layer will be used by the GUI thread
+            layer.moveToThread(QApplication.instance().thread())
+            self.emit(SIGNAL("layerLoaded(PyQt_PyObject)"), layer)
+
+    def loadLayer(self):
+        builder = querylayer.QueryLayer(self.db, self.query, self.layerName, self.geomFieldName,
+                                        self.uniqueFieldName, self.cache, self.materialize)
+        # the columns of the result are read first (LIMIT 0 on PostGIS), so
+        # a wrong geometry or unique column doesn't cost a failed load
+        columns = builder.detectColumns()
+        self.emit(SIGNAL("columnsDetected(PyQt_PyObject, PyQt_PyObject, PyQt_PyObject)"), columns, builder.geom, builder.key)
+        builder.checkColumns()
+        self.geomFieldName, self.uniqueFieldName = builder.geom, builder.key
+        if self.cancelled:
+            return None
+
+        uri = builder.dataSourceURI()
+        if self.cancelled:
+            return None
+
+        metadata = builder.metadata(uri)
+        if metadata is not None:
+            self.rows = metadata['count']
+            builder.applyMetadata(uri, metadata)
+        if self.cancelled:
+            return None
+        return builder.layer(uri, metadata)
+
+
+class ExplainWorker(QThread):
+    """ Gets the plans of queries on a pooled connection.
+
+    Emits planReady(PyQt_PyObject) with a list of (query, root PlanNode),
+    queryError(QString) when a query fails and queryCancelled() after cancel().
+    With analyze=True the queries are run, so that the plans have the actual
+    timings and rows.
+    """
+
+    def __init__(self, pool, queries, analyze=False, parent=None):
+        QThread.__init__(self, parent)
+        self.pool = pool
+        self.queries = queries
+        self.analyze = analyze
+
+        self.db = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        db = self.db
+        if db is not None:
+            db.cancel()
+
+    def run(self):
+        try:
+            self.explainQueries()
+        except Exception, e:
+            # e.g. a plan the connector can't parse: it's reported,
+            # not just printed on the console
+            self.emit(SIGNAL("queryError(QString)"), error_message(e))
+
+    def explainQueries(self):
+        try:
+            self.db = self.pool.acquire(QueryWorker.ACQUIRE_TIMEOUT)
+        except DbConnection.DbError, e:
+            self.emit(SIGNAL("queryError(QString)"), unicode(e.msg))
+            return
+
+        plans = []
+        try:
+            try:
+                for query in self.queries:
+                    if self.cancelled:
+                        break
+                    plans.append((query, self.db.explain(query, self.analyze)))
+            except DbConnection.DbError, e:
+                if not self.cancelled:
+                    self.emit(SIGNAL("queryError(QString)"), unicode(e.msg))
+                    return
+        finally:
+            db, self.db = self.db, None
+            DbConnection.ConnectionManager.releaseConnection(db)
+
+        if self.cancelled:
+            self.emit(SIGNAL("queryCancelled()"))
+        else:
+            self.emit(SIGNAL("planReady(PyQt_PyObject)"), plans)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+A small tokenizer for PostgreSQL/PostGIS and SpatiaLite queries, much
+faster than the generic pygments SqlLexer. Token types are the names of
+the pygments tokens ('Token.Keyword', ...) so the same styles apply.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import re
+
+
+# Block states. A block ending inside a construct that can span several
+# lines stores it with setCurrentBlockState(), so that the next block
+# can be lexed on its own.
+NORMAL, IN_STRING, IN_IDENTIFIER = 0, 1, 2
+IN_COMMENT = 3          # + nesting depth - 1
+IN_DOLLAR = 1000        # + index of the tag in dollar_tags
+
+dollar_tags = []
+dollar_states = {}
+
+def dollar_state(tag):
+    """ state of a block ending inside a $tag$ quoted string """
+    if tag not in dollar_states:
+        dollar_states[tag] = IN_DOLLAR + len(dollar_tags)
+        dollar_tags.append(tag)
+    return dollar_states[tag]
+
+# tokens given to the parts of a block which aren't plain code
+SEGMENT_TOKENS = {
+    'comment': 'Token.Comment.Multiline',
+    'line_comment': 'Token.Comment.Single',
+    'string': 'Token.Literal.String.Single',
+    'identifier': 'Token.Literal.String.Symbol',
+    'dollar': 'Token.Literal.String',
+}
+
+_OPENING = re.compile(r"--|/\*|'|\"|(?<![\w$])\$(?:[A-Za-z_]\w*)?\$", re.UNICODE)
+_COMMENT_DELIM = re.compile(r"/\*|\*/")
+_STRING_END = re.compile(r"(?:[^']|'')*'(?!')")
+_IDENTIFIER_END = re.compile(r'(?:[^"]|"")*"(?!")')
+
+def _segment_kind(state):
+    if state == NORMAL:
+        return 'code'
+    if state == IN_STRING:
+        return 'string'
+    if state == IN_IDENTIFIER:
+        return 'identifier'
+    if state >= IN_DOLLAR:
+        return 'dollar'
+    return 'comment'
+
+def scan_block(text, state):
+    """ split the text of a block in (start, length, kind) segments, kind is 'code'
+    or the kind of string or comment. state is the one of the previous block.
+    Returns the segments and the state at the end of this block.
+    """
+    if state < 0:
+        state = NORMAL
+    segments = []
+    n = len(text)
+    start = pos = 0
+    while pos < n:
+        if state == NORMAL:
+            m = _OPENING.search(text, pos)
+            if m is None:
+                break
+            if m.start() > start:
+                segments.append((start, m.start() - start, 'code'))
+            start, pos = m.start(), m.end()
+            delim = m.group()
+            if delim == '--':
+                end = text.find('\n', pos)
+                if end < 0:
+                    end = n
+                segments.append((start, end - start, 'line_comment'))
+                start = pos = end
+            elif delim == '/*':
+                state = IN_COMMENT
+            elif delim == "'":
+                state = IN_STRING
+            elif delim == '"':
+                state = IN_IDENTIFIER
+            else:
+                state = dollar_state(delim)
+            continue
+
+        kind = _segment_kind(state)
+        if state == IN_STRING or state == IN_IDENTIFIER:
+            m = (_STRING_END if state == IN_STRING else _IDENTIFIER_END).match(text, pos)
+            if m is None:
+                break
+            pos = m.end()
+        elif state >= IN_DOLLAR:
+            tag = dollar_tags[state - IN_DOLLAR]
+            end = text.find(tag, pos)
+            if end < 0:
+                break
+            pos = end + len(tag)
+        else:
+            # comments can be nested
+            depth = state - IN_COMMENT + 1
+            while depth > 0:
+                m = _COMMENT_DELIM.search(text, pos)
+                if m is None:
+                    break
+                pos = m.end()
+                depth += 1 if m.group() == '/*' else -1
+            if depth > 0:
+                state = IN_COMMENT + depth - 1
+                break
+
+        segments.append((start, pos - start, kind))
+        start = pos
+        state = NORMAL
+
+    if start < n:
+        segments.append((start, n - start, _segment_kind(state)))
+    return segments, state
+
+
+def split_statements(text):
+    """ split a text at the semicolons which aren't in a string, a quoted
+    identifier, a comment or a $$ body. Returns the statements, stripped,
+    without the ones made of comments and blanks only. A statement may
+    end with a -- comment: wrap it as "(" + statement + "\n)" """
+    segments, state = scan_block(text, NORMAL)
+    statements = []
+    start = 0
+    # whether the current statement has only comments and blanks so far
+    blank = True
+    for begin, length, kind in segments:
+        if kind == 'comment' or kind == 'line_comment':
+            continue
+        if kind != 'code':
+            blank = False
+            continue
+        end = begin + length
+        pos = text.find(';', begin, end)
+        while pos >= 0:
+            if not blank or text[begin:pos].strip():
+                statements.append(text[start:pos].strip())
+            start = begin = pos + 1
+            blank = True
+            pos = text.find(';', start, end)
+        if text[begin:end].strip():
+            blank = False
+    if not blank:
+        statements.append(text[start:].strip())
+    return statements
+
+
+KEYWORDS = set("""
+ABORT ALL ALTER ANALYZE AND ANY ARRAY AS ASC ASYMMETRIC AUTHORIZATION BEGIN
+BETWEEN BOTH BY CASCADE CASE CAST CHECK COLLATE COLUMN COMMIT CONCURRENTLY
+CONSTRAINT COPY CREATE CROSS CURRENT_DATE CURRENT_TIME CURRENT_TIMESTAMP
+CURRENT_USER DATABASE DEFAULT DEFERRABLE DELETE DESC DISTINCT DO DROP ELSE END
+EXCEPT EXISTS EXPLAIN EXTENSION FALSE FETCH FILTER FOR FOREIGN FROM FULL
+FUNCTION GRANT GROUP HAVING IF ILIKE IN INDEX INHERITS INITIALLY INNER INSERT
+INTERSECT INTO IS ISNULL JOIN KEY LANGUAGE LATERAL LEADING LEFT LIKE LIMIT
+LOCALTIME LOCALTIMESTAMP MATERIALIZED NATURAL NOT NOTNULL NULL NULLS OFFSET
+ON ONLY OR ORDER OUTER OVER OVERLAPS PARTITION PLACING PRAGMA PRIMARY
+RECURSIVE REFERENCES REINDEX RENAME REPLACE RETURNING RETURNS REVOKE RIGHT
+ROLLBACK ROW ROWS SCHEMA SELECT SEQUENCE SESSION_USER SET SIMILAR SOME
+SYMMETRIC TABLE TABLESAMPLE TEMP TEMPORARY THEN TO TRAILING TRIGGER TRUE
+TRUNCATE UNION UNIQUE UNLOGGED UPDATE USER USING VACUUM VALUES VARIADIC
+VERBOSE VIEW WHEN WHERE WINDOW WITH WITHIN
+""".split())
+
+DATA_TYPES = set("""
+BIGINT BIGSERIAL BIT BLOB BOOL BOOLEAN BOX2D BOX3D BYTEA CHAR CHARACTER DATE
+DECIMAL DOUBLE FLOAT FLOAT4 FLOAT8 GEOGRAPHY GEOMETRY HSTORE INT INT2 INT4
+INT8 INTEGER INTERVAL JSON JSONB NUMERIC OID PRECISION RASTER REAL REGCLASS
+SERIAL SMALLINT TEXT TIME TIMESTAMP TIMESTAMPTZ UUID VARCHAR VARYING
+""".split())
+
+# PostGIS functions without the ST_ prefix, and the SpatiaLite ones
+FUNCTIONS = set(name.upper() for name in """
+AddGeometryColumn DropGeometryColumn DropGeometryTable UpdateGeometrySRID
+Find_SRID PostGIS_Version PostGIS_Full_Version PostGIS_Lib_Version
+Populate_Geometry_Columns
+InitSpatialMetadata CreateSpatialIndex DisableSpatialIndex CheckSpatialIndex
+RecoverGeometryColumn DiscardGeometryColumn RecoverSpatialIndex
+CreateMbrCache UpdateLayerStatistics spatialite_version
+MakePoint MakeLine MakePolygon BuildMbr GeomFromText GeomFromWKB GeomFromGeoJSON
+PointFromText LineFromText PolygonFromText AsText AsBinary AsGeoJSON AsKml
+AsSvg Transform Buffer Area Length Perimeter Distance Intersects Contains
+Within Touches Crosses Overlaps Disjoint Equals Intersection Union
+Difference SymDifference Centroid PointOnSurface Envelope Simplify
+SimplifyPreserveTopology IsValid IsEmpty IsSimple SRID SetSRID
+GeometryType CastToMulti CastToSingle MbrIntersects MbrContains MbrWithin
+MbrMinX MbrMinY MbrMaxX MbrMaxY NumPoints NumGeometries GeometryN
+COUNT SUM AVG MIN MAX COALESCE NULLIF GREATEST LEAST STRING_AGG ARRAY_AGG
+ROW_NUMBER RANK DENSE_RANK
+""".split())
+
+# the token types, named as in pygments
+KEYWORD = 'Token.Keyword'
+BUILTIN = 'Token.Name.Builtin'
+FUNCTION = 'Token.Name.Function'
+NAME = 'Token.Name'
+VARIABLE = 'Token.Name.Variable'
+FLOAT = 'Token.Literal.Number.Float'
+INTEGER = 'Token.Literal.Number.Integer'
+OPERATOR = 'Token.Operator'
+PUNCTUATION = 'Token.Punctuation'
+TEXT = 'Token.Text'
+ERROR = 'Token.Error'
+
+# One precompiled pattern for everything a code segment may contain,
+# tried in this order at each position. The last alternative matches
+# any other character, so the matches cover the whole text.
+_CODE = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<word>[^\W\d][\w$]*)
+    | (?P<float>(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)
+    | (?P<integer>\d+)
+    | (?P<variable>\$\d+|[:@][^\W\d]\w*)
+    | (?P<operator>::|[-+*/<>=~!@#%^&|`?]+)
+    | (?P<punctuation>[(),;.\[\]{}])
+    | (?P<error>.)
+    """, re.UNICODE | re.VERBOSE | re.DOTALL)
+
+_GROUP_TOKENS = {
+    'space': TEXT,
+    'float': FLOAT,
+    'integer': INTEGER,
+    'variable': VARIABLE,
+    'operator': OPERATOR,
+    'punctuation': PUNCTUATION,
+    'error': ERROR,
+}
+
+
+class SqlTokenizer(object):
+    """ Tokenizes SQL, with the same interface as a pygments lexer """
+
+    name = 'SQL'
+
+    def __init__(self):
+        # word -> token type, the classification of a word is done once
+        self.words = {}
+
+    def wordToken(self, word):
+        ttype = self.words.get(word)
+        if ttype is None:
+            upper = word.upper()
+            if upper in KEYWORDS:
+                ttype = KEYWORD
+            elif upper in DATA_TYPES:
+                ttype = BUILTIN
+            elif upper.startswith('ST_') or upper in FUNCTIONS:
+                ttype = FUNCTION
+            else:
+                ttype = NAME
+            if len(self.words) < 10000:
+                self.words[word] = ttype
+        return ttype
+
+    def code_tokens(self, text, offset=0):
+        """ (index, token type, value) of code, without strings or comments """
+        words = self.words
+        for m in _CODE.finditer(text):
+            value = m.group()
+            group = m.lastgroup
+            if group == 'word':
+                ttype = words.get(value) or self.wordToken(value)
+            else:
+                ttype = _GROUP_TOKENS[group]
+            yield offset + m.start(), ttype, value
+
+    def get_tokens_unprocessed(self, text, state=NORMAL):
+        """ (index, token type, value) of the whole text """
+        segments, state = scan_block(text, state)
+        for start, length, kind in segments:
+            value = text[start:start+length]
+            if kind == 'code':
+                for token in self.code_tokens(value, start):
+                    yield token
+            else:
+                yield start, SEGMENT_TOKENS[kind], value
+
+    def first_keyword(self, statement):
+        """ the first keyword of a statement (upper case), None if it
+        doesn't start with one. Comments and parentheses are skipped """
+        for index, ttype, value in self.get_tokens_unprocessed(statement):
+            if ttype == KEYWORD:
+                return value.upper()
+            if ttype != TEXT and ttype != PUNCTUATION and not ttype.startswith('Token.Comment'):
+                return None
+        return None
+
+    def is_query(self, statement):
+        """ whether a statement returns rows: a SELECT or a WITH """
+        return self.first_keyword(statement) in ('SELECT', 'WITH')
+
+    def get_tokens(self, text):
+        """ (token type, value) pairs, as pygments lexers give them """
+        for index, ttype, value in self.get_tokens_unprocessed(text):
+            yield ttype, value
+
+
+if __name__ == '__main__':
+    # Compare with pygments: python sqltokenizer.py [file.sql]
+    import sys
+    import time
+
+    if len(sys.argv) > 1:
+        sql = open(sys.argv[1]).read()
+    else:
+        sql = (
+            "-- parcels close to a road\n"
+            "SELECT p.gid, p.owner, ST_Area(p.geom) / 10000.0 AS ha,\n"
+            "       ST_Transform(ST_Buffer(p.geom, 25), 4326) AS geom\n"
+            "  FROM cadastre.parcels p JOIN roads r\n"
+            "    ON ST_DWithin(p.geom, r.geom, 50) /* index scan */\n"
+            " WHERE r.kind = 'highway' AND p.gid > $1 AND p.tags::text LIKE \"%x%\"\n"
+            " ORDER BY ha DESC LIMIT 100;\n"
+            "CREATE FUNCTION f() RETURNS int AS $$ SELECT 1 $$ LANGUAGE sql;\n"
+        ) * 2000
+    lines = sql.splitlines()
+
+    def run(lexer):
+        started = time.time()
+        count = 0
+        for line in lines:
+            for token in lexer.get_tokens_unprocessed(line):
+                count += 1
+        return time.time() - started, count
+
+    fast, count = run(SqlTokenizer())
+    print("sqltokenizer: %.3f s, %d tokens, %d lines" % (fast, count, len(lines)))
+    try:
+        from pygments.lexers import get_lexer_by_name
+    except ImportError:
+        sys.exit(0)
+    slow, count = run(get_lexer_by_name('sql'))
+    print("pygments:     %.3f s, %d tokens (%.1fx slower)" % (slow, count, slow / fast))
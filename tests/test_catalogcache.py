@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the catalog cache of the connections.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# DbConnection needs PyQt4 and QGIS
+try:
+    import DbConnection
+except ImportError:
+    DbConnection = None
+
+
+@unittest.skipIf(DbConnection is None, "PyQt4 and QGIS are needed")
+class CatalogCacheTest(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = DbConnection.CatalogCache(ttl=60, maxsize=10)
+        self.assertEqual(cache.get('a'), (False, None))
+        cache.put('a', [1])
+        self.assertEqual(cache.get('a'), (True, [1]))
+        self.assertEqual(cache.stats(), (1, 1, 1))
+
+    def test_ttl(self):
+        cache = DbConnection.CatalogCache(ttl=0.01, maxsize=10)
+        cache.put('a', 1)
+        time.sleep(0.05)
+        self.assertEqual(cache.get('a'), (False, None))
+
+    def test_least_recently_used_dropped(self):
+        cache = DbConnection.CatalogCache(ttl=60, maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('c'), (True, 3))
+
+    def test_invalidate(self):
+        cache = DbConnection.CatalogCache()
+        cache.put('a', 1)
+        cache.invalidate()
+        self.assertEqual(cache.get('a'), (False, None))
+
+
+class Catalog:
+    """ the decorated methods of a connection """
+
+    def __init__(self):
+        self.catalog_cache = DbConnection.CatalogCache()
+        self.reads = 0
+
+    def list_tables(self, schema=None):
+        self.reads += 1
+        return [schema]
+
+    def create_table(self, table):
+        pass
+
+    def close(self):
+        pass
+
+    def is_alive(self):
+        return True
+
+    def reset(self):
+        pass
+
+if DbConnection is not None:
+    Catalog.list_tables = DbConnection.cached_catalog(Catalog.list_tables.im_func)
+    Catalog.create_table = DbConnection.invalidates_catalog(Catalog.create_table.im_func)
+
+
+@unittest.skipIf(DbConnection is None, "PyQt4 and QGIS are needed")
+class CatalogDecoratorsTest(unittest.TestCase):
+
+    def test_cached_by_arguments(self):
+        catalog = Catalog()
+        self.assertEqual(catalog.list_tables('public'), ['public'])
+        self.assertEqual(catalog.list_tables('public'), ['public'])
+        self.assertEqual(catalog.reads, 1)
+        catalog.list_tables(schema='other')
+        self.assertEqual(catalog.reads, 2)
+
+    def test_invalidated_by_schema_changes(self):
+        catalog = Catalog()
+        catalog.list_tables()
+        catalog.create_table('t')
+        catalog.list_tables()
+        self.assertEqual(catalog.reads, 2)
+
+    def test_shared_by_the_connections_of_a_pool(self):
+        pool = DbConnection.ConnectionPool(Catalog, minsize=0, maxsize=2)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertTrue(first.catalog_cache is second.catalog_cache)
+        first.list_tables()
+        second.list_tables()
+        self.assertEqual(first.reads + second.reads, 1)
+        # a change made on one connection is seen by the others
+        second.create_table('t')
+        first.list_tables()
+        self.assertEqual(first.reads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
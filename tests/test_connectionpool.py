@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the pool of connections.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# DbConnection needs PyQt4 and QGIS
+try:
+    import DbConnection
+except ImportError:
+    DbConnection = None
+
+
+class FakeConnection:
+    """ what the pool uses of a connection """
+
+    def __init__(self):
+        self.catalog_cache = DbConnection.CatalogCache()
+        self.alive = True
+        self.closed = False
+
+    def is_alive(self):
+        return self.alive
+
+    def reset(self):
+        if not self.alive:
+            raise DbConnection.DbError(u"connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(DbConnection is None, "PyQt4 and QGIS are needed")
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+
+    def factory(self):
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    def test_reuse(self):
+        pool = DbConnection.ConnectionPool(self.factory)
+        conn = pool.acquire()
+        self.assertTrue(conn.pool is pool)
+        pool.release(conn)
+        self.assertTrue(pool.acquire() is conn)
+        self.assertEqual(len(self.opened), 1)
+        self.assertTrue(pool.connected)
+
+    def test_maxsize(self):
+        pool = DbConnection.ConnectionPool(self.factory, maxsize=2)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertFalse(first is second)
+        started = time.time()
+        self.assertRaises(DbConnection.DbError, pool.acquire, 0.1)
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def test_waits_for_a_release(self):
+        pool = DbConnection.ConnectionPool(self.factory, maxsize=1)
+        conn = pool.acquire()
+        timer = threading.Timer(0.1, pool.release, [conn])
+        timer.start()
+        try:
+            self.assertTrue(pool.acquire(5) is conn)
+        finally:
+            timer.join()
+
+    def test_dead_connection_replaced(self):
+        pool = DbConnection.ConnectionPool(self.factory)
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.alive = False
+        other = pool.acquire()
+        self.assertFalse(other is conn)
+        self.assertTrue(conn.closed)
+
+    def test_failed_reset_closes(self):
+        pool = DbConnection.ConnectionPool(self.factory, maxsize=1)
+        conn = pool.acquire()
+        conn.alive = False
+        pool.release(conn)
+        self.assertTrue(conn.closed)
+        # its slot is free again
+        self.assertFalse(pool.acquire(0.1) is conn)
+
+    def test_idle_eviction(self):
+        pool = DbConnection.ConnectionPool(self.factory, minsize=1, maxsize=2, idle_timeout=0)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        # minsize connections are kept open
+        self.assertEqual(len(pool.idle), 1)
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+
+    def test_failed_factory_gives_back_the_slot(self):
+        def factory():
+            raise DbConnection.DbError(u"no server")
+        pool = DbConnection.ConnectionPool(factory, maxsize=1)
+        self.assertRaises(DbConnection.DbError, pool.acquire, 0.1)
+        self.assertEqual(pool.busy, 0)
+        self.assertFalse(pool.connected)
+
+    def test_close(self):
+        pool = DbConnection.ConnectionPool(self.factory, maxsize=2)
+        idle, busy = pool.acquire(), pool.acquire()
+        pool.release(idle)
+        pool.close()
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+        pool.release(busy)
+        self.assertTrue(busy.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
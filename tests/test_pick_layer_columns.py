@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the choice of the geometry and unique columns of a layer.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# DbConnection needs PyQt4 and QGIS
+try:
+    import DbConnection
+except ImportError:
+    DbConnection = None
+
+
+@unittest.skipIf(DbConnection is None, "PyQt4 and QGIS are needed")
+class PickLayerColumnsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = DbConnection.Connection(None)
+
+    def pick(self, columns, geom=None, key=None):
+        return self.conn.pick_layer_columns(columns, geom, key)
+
+    def test_detected(self):
+        columns = [('name', None), ('gid', 'integer'), ('the_geom', 'geometry')]
+        self.assertEqual(self.pick(columns), ('the_geom', 'gid'))
+
+    def test_wanted_columns_kept(self):
+        columns = [('id', 'integer'), ('code', None), ('a', 'geometry'), ('b', 'geometry')]
+        self.assertEqual(self.pick(columns, 'b', 'code'), ('b', 'code'))
+
+    def test_wanted_geometry_not_a_geometry(self):
+        columns = [('id', 'integer'), ('name', None), ('geom', 'geometry')]
+        self.assertEqual(self.pick(columns, 'name', 'id'), ('geom', 'id'))
+
+    def test_geometry_of_unknown_kind(self):
+        # e.g. SpatiaLite, whose first row has a NULL geometry
+        columns = [('id', 'integer'), ('geom', None)]
+        self.assertEqual(self.pick(columns, 'geom'), ('geom', 'id'))
+        self.assertEqual(self.pick(columns, 'the_geom'), (None, 'id'))
+
+    def test_key_names_order(self):
+        columns = [('fid', 'integer'), ('id', 'integer'), ('geom', 'geometry')]
+        self.assertEqual(self.pick(columns, 'geom', 'gid'), ('geom', 'id'))
+
+    def test_other_integer_columns_not_picked(self):
+        # any integer column may have duplicates
+        columns = [('population', 'integer'), ('geom', 'geometry')]
+        self.assertEqual(self.pick(columns), ('geom', None))
+
+    def test_key_of_unknown_kind(self):
+        columns = [('pk', None), ('geom', 'geometry')]
+        self.assertEqual(self.pick(columns), ('geom', 'pk'))
+
+
+if __name__ == '__main__':
+    unittest.main()
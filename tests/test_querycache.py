@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the fingerprints of the queries and of the query cache index.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# querycache needs QGIS
+try:
+    import DbConnection
+    import querycache
+except ImportError:
+    querycache = None
+
+CONNECTION = ('postgis', 'gis', "dbname='gis' host=db port=5432 user='me' password='se\\'cret' sslmode=disable")
+
+
+class FakePool:
+
+    def __init__(self, key):
+        self.key = key
+
+
+class FakeDb:
+    """ a PostGIS connection whose user can't create anything """
+
+    def __init__(self, code=None):
+        self.pool = FakePool(CONNECTION)
+        self.code = code
+
+    def getTypeName(self):
+        return 'postgis'
+
+    def check_query(self, query):
+        raise DbConnection.DbError(u'relation does not exist')
+
+    def create_schema(self, schema, if_not_exists=False):
+        error = DbConnection.DbError(u'permission denied for database gis')
+        error.code = self.code
+        raise error
+
+
+@unittest.skipIf(querycache is None, "PyQt4 and QGIS are needed")
+class FingerprintTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(querycache.normalize("select  a,\n\tb -- the columns\nfrom t;"), "SELECT a, b FROM t")
+
+    def test_normalize_keeps_strings(self):
+        self.assertEqual(querycache.normalize("select 'a  -- b'"), "SELECT 'a  -- b'")
+
+    def test_formatting_gives_the_same_fingerprint(self):
+        self.assertEqual(querycache.fingerprint(CONNECTION, "select * from t"),
+                         querycache.fingerprint(CONNECTION, "SELECT *\n  FROM t -- all of it\n;"))
+
+    def test_fingerprint_of_the_connection(self):
+        other = ('postgis', 'other', CONNECTION[2])
+        self.assertNotEqual(querycache.fingerprint(CONNECTION, "SELECT 1"), querycache.fingerprint(other, "SELECT 1"))
+        self.assertNotEqual(querycache.fingerprint(CONNECTION, "SELECT 1"), querycache.fingerprint(CONNECTION, "SELECT 2"))
+
+    def test_no_password(self):
+        name = querycache.connection_name(CONNECTION)
+        self.assertFalse('password' in name)
+        self.assertFalse('cret' in name)
+        self.assertTrue("user='me'" in name)
+        self.assertTrue("sslmode=disable" in name)
+
+    def test_password_change_keeps_the_fingerprint(self):
+        changed = CONNECTION[:2] + (CONNECTION[2].replace("se\\'cret", "new"),)
+        self.assertEqual(querycache.fingerprint(CONNECTION, "SELECT 1"), querycache.fingerprint(changed, "SELECT 1"))
+
+
+@unittest.skipIf(querycache is None, "PyQt4 and QGIS are needed")
+class QueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_passwords_removed_from_older_indexes(self):
+        con = sqlite3.connect(self.path)
+        con.execute("""CREATE TABLE query_cache (
+            fingerprint TEXT PRIMARY KEY, connection TEXT, query TEXT,
+            schema_name TEXT, table_name TEXT,
+            created REAL, used REAL, rows INTEGER, bytes INTEGER)""")
+        con.execute("INSERT INTO query_cache (fingerprint, connection) VALUES ('f', ?)",
+                    (u"|".join(CONNECTION),))
+        con.commit()
+        con.close()
+
+        cache = querycache.QueryCache(self.path)
+        try:
+            connection = cache.con.execute("SELECT connection FROM query_cache").fetchone()[0]
+        finally:
+            cache.close()
+        self.assertEqual(connection, querycache.connection_name(CONNECTION))
+
+    def test_no_create_privilege(self):
+        cache = querycache.QueryCache(self.path)
+        try:
+            db = FakeDb(cache.INSUFFICIENT_PRIVILEGE)
+            self.assertTrue(cache.supports(db))
+            self.assertTrue(cache.getURI(db, CONNECTION, "SELECT 1", "geom", "id") is None)
+            # the next runs don't try again
+            self.assertFalse(cache.supports(db))
+        finally:
+            cache.close()
+
+    def test_other_errors_raised(self):
+        cache = querycache.QueryCache(self.path)
+        try:
+            db = FakeDb()
+            self.assertRaises(DbConnection.DbError, cache.getURI, db, CONNECTION, "SELECT 1", "geom", "id")
+            self.assertTrue(cache.supports(db))
+        finally:
+            cache.close()
+
+
+class TablesDb:
+    """ a PostGIS connection with some tables, some can't be dropped """
+
+    def __init__(self, tables, locked=()):
+        self.tables = set(tables)
+        self.locked = locked
+
+    def getTypeName(self):
+        return 'postgis'
+
+    def check_query(self, query):
+        for schema, table in self.tables:
+            if query == u'SELECT 1 FROM "%s"."%s"' % (schema, table):
+                return
+        raise DbConnection.DbError(u'relation does not exist')
+
+    def delete_table(self, table, schema=None):
+        if (schema, table) in self.locked:
+            raise DbConnection.DbError(u'table in use')
+        self.tables.remove((schema, table))
+
+
+@unittest.skipIf(querycache is None, "PyQt4 and QGIS are needed")
+class MaterializedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = querycache.QueryCache(os.path.join(self.directory, 'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_tables_of_a_connection(self):
+        other = ('postgis', 'other', CONNECTION[2])
+        self.cache.addMaterialized(CONNECTION, 'fsl_layers', 'a')
+        self.cache.addMaterialized(other, 'fsl_layers', 'b')
+        self.assertEqual(self.cache.materializedTables(CONNECTION), [('fsl_layers', 'a')])
+
+    def test_only_the_chosen_tables_dropped(self):
+        tables = [('fsl_layers', 'a'), ('fsl_layers', 'b'), ('fsl_layers', 'c')]
+        db = TablesDb(tables, locked=[('fsl_layers', 'c')])
+        for schema, table in tables:
+            self.cache.addMaterialized(CONNECTION, schema, table)
+
+        dropped = self.cache.dropMaterialized(db, CONNECTION, tables[1:])
+        self.assertEqual(dropped, [('fsl_layers', 'b')])
+        self.assertEqual(db.tables, set([('fsl_layers', 'a'), ('fsl_layers', 'c')]))
+        # the one in use is still listed
+        self.assertEqual(sorted(self.cache.materializedTables(CONNECTION)), [('fsl_layers', 'a'), ('fsl_layers', 'c')])
+
+
+if __name__ == '__main__':
+    unittest.main()
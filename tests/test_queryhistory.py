@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the query history.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# queryhistory needs QGIS
+try:
+    import queryhistory
+except ImportError:
+    queryhistory = None
+
+CONNECTION = ('postgis', 'gis')
+
+
+@unittest.skipIf(queryhistory is None, "PyQt4 and QGIS are needed")
+class QueryHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'history.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def history(self, max_entries=1000):
+        history = queryhistory.QueryHistory(self.path, max_entries)
+        self.addCleanup(history.close)
+        return history
+
+    def test_entry(self):
+        history = self.history()
+        history.add(CONNECTION, "select gid,\n geom from t;", 1.5, 10, 'gid', 'geom')
+        entry = history.entries()[0]
+        self.assertEqual((entry.conntype, entry.connection), CONNECTION)
+        self.assertEqual(entry.query, "SELECT gid, geom FROM t")
+        self.assertEqual((entry.wall_time, entry.rows, entry.key, entry.geom), (1.5, 10, 'gid', 'geom'))
+        self.assertTrue(entry.success)
+        self.assertEqual(history.get(entry.id).query, entry.query)
+        self.assertTrue(history.get(entry.id + 1) is None)
+
+    def test_error(self):
+        history = self.history()
+        history.add(CONNECTION, "SELECT x", 0.1, error=u"column x does not exist")
+        entry = history.entries()[0]
+        self.assertFalse(entry.success)
+        self.assertEqual(entry.error, u"column x does not exist")
+
+    def test_cap(self):
+        history = self.history(max_entries=5)
+        for i in range(12):
+            history.add(CONNECTION, "SELECT %d" % i, i)
+        entries = history.entries()
+        self.assertEqual(len(entries), 5)
+        # the last ones are kept, the last one first
+        self.assertEqual([entry.query for entry in entries], ["SELECT %d" % i for i in range(11, 6, -1)])
+
+    def test_slowest_first(self):
+        history = self.history()
+        for wall_time in (2.0, 5.0, 1.0):
+            history.add(CONNECTION, "SELECT 1", wall_time)
+        self.assertEqual([entry.wall_time for entry in history.entries(by_latency=True, limit=2)], [5.0, 2.0])
+
+    def test_clear(self):
+        history = self.history()
+        history.add(CONNECTION, "SELECT 1", 1.0)
+        history.clear()
+        self.assertEqual(history.entries(), [])
+
+    def test_older_history(self):
+        # written before the type of the connection was kept
+        con = sqlite3.connect(self.path)
+        con.execute("""CREATE TABLE history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, connection TEXT, query TEXT,
+            wall_time REAL, rows INTEGER, key TEXT, geom TEXT, success INTEGER, error TEXT)""")
+        con.execute("INSERT INTO history (time, connection, query, wall_time, success) VALUES (0, 'gis', 'SELECT 1', 1.0, 1)")
+        con.commit()
+        con.close()
+
+        history = self.history()
+        history.add(CONNECTION, "SELECT 2", 2.0)
+        entries = history.entries()
+        self.assertEqual([(entry.conntype, entry.connection, entry.query) for entry in entries],
+                         [('postgis', 'gis', 'SELECT 2'), (None, 'gis', 'SELECT 1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the layers built without the dock.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# querylayer needs PyQt4 and QGIS
+try:
+    import querylayer
+except ImportError:
+    querylayer = None
+
+
+@unittest.skipIf(querylayer is None, "PyQt4 and QGIS are needed")
+class MaterializedTableNameTest(unittest.TestCase):
+
+    def name(self, layerName):
+        return querylayer.QueryLayer(None, "SELECT 1", layerName).materializedTableName()
+
+    def test_unique(self):
+        # the layers of a batch have the same name, in the same second
+        names = set([self.name(u"parcels") for i in range(100)])
+        self.assertEqual(len(names), 100)
+
+    def test_identifier(self):
+        name = self.name(u"Parcels of the river basin (2014) " * 4)
+        self.assertTrue(len(name) <= 63)
+        self.assertTrue(name.startswith(u"parcels_of_the_river_basin_2014_"))
+        self.assertTrue(self.name(u"---").startswith(u"querylayer_"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Tests of the SQL tokenizer and of the statement splitter.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqltokenizer
+from sqltokenizer import (SqlTokenizer, split_statements, scan_block, NORMAL, IN_STRING, IN_COMMENT,
+                          SEGMENT_TOKENS, KEYWORD, FUNCTION, TEXT)
+
+
+class SplitStatementsTest(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEqual(split_statements("SELECT 1; SELECT 2"), ["SELECT 1", "SELECT 2"])
+
+    def test_blank_statements(self):
+        self.assertEqual(split_statements(" ;; SELECT 1 ;\n;"), ["SELECT 1"])
+        self.assertEqual(split_statements(""), [])
+
+    def test_semicolons_not_splitting(self):
+        for sql in ("SELECT 'a;b'", 'SELECT 1 AS "a;b"', "SELECT 1 /* a;b */",
+                    "SELECT 1 -- a;b", "SELECT $$a;b$$", "SELECT $x$a;b$x$"):
+            self.assertEqual(split_statements(sql), [sql])
+
+    def test_comment_only_statements(self):
+        self.assertEqual(split_statements("SELECT 1; -- the end"), ["SELECT 1"])
+        self.assertEqual(split_statements("SELECT 1; /* a */ ; SELECT 2"), ["SELECT 1", "SELECT 2"])
+        self.assertEqual(split_statements("-- nothing\n/* to run */"), [])
+
+    def test_trailing_comment(self):
+        # kept with its statement, see querylayer.QueryLayer.dataSourceURI
+        self.assertEqual(split_statements("SELECT 1 -- one\n;SELECT 2"), ["SELECT 1 -- one", "SELECT 2"])
+
+    def test_leading_comment(self):
+        self.assertEqual(split_statements("-- parcels\nSELECT * FROM parcels;"), ["-- parcels\nSELECT * FROM parcels"])
+
+
+class ScanBlockTest(unittest.TestCase):
+
+    def test_segments(self):
+        text = "SELECT 'a' -- b"
+        segments, state = scan_block(text, NORMAL)
+        self.assertEqual([kind for start, length, kind in segments], ['code', 'string', 'code', 'line_comment'])
+        self.assertEqual(u"".join([text[start:start + length] for start, length, kind in segments]), text)
+        self.assertEqual(state, NORMAL)
+
+    def test_states_across_blocks(self):
+        segments, state = scan_block("SELECT 'a", NORMAL)
+        self.assertEqual(state, IN_STRING)
+        segments, state = scan_block("b' /* c", state)
+        self.assertEqual(segments[0][2], 'string')
+        self.assertEqual(state, IN_COMMENT)
+        segments, state = scan_block("*/ 1", state)
+        self.assertEqual(segments[0][2], 'comment')
+        self.assertEqual(state, NORMAL)
+
+    def test_nested_comments(self):
+        segments, state = scan_block("/* a /* b */", NORMAL)
+        self.assertEqual(state, IN_COMMENT)
+        segments, state = scan_block("c */ SELECT", state)
+        self.assertEqual(state, NORMAL)
+
+    def test_dollar_quotes(self):
+        segments, state = scan_block("AS $body$ SELECT", NORMAL)
+        self.assertEqual(state, sqltokenizer.dollar_state('$body$'))
+        segments, state = scan_block("1 $body$;", state)
+        self.assertEqual(state, NORMAL)
+
+
+class SqlTokenizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tokenizer = SqlTokenizer()
+
+    def test_tokens_cover_the_text(self):
+        text = u"SELECT gid, ST_Area(geom) AS \"área\" FROM t WHERE name = 'x' -- c"
+        tokens = list(self.tokenizer.get_tokens_unprocessed(text))
+        self.assertEqual(u"".join([value for index, ttype, value in tokens]), text)
+        for index, ttype, value in tokens:
+            self.assertEqual(text[index:index + len(value)], value)
+
+    def test_token_types(self):
+        tokens = dict([(value, ttype) for index, ttype, value in self.tokenizer.get_tokens_unprocessed(
+            "select ST_Buffer(geom, 1) from t -- c")])
+        self.assertEqual(tokens['select'], KEYWORD)
+        self.assertEqual(tokens['from'], KEYWORD)
+        self.assertEqual(tokens['ST_Buffer'], FUNCTION)
+        self.assertEqual(tokens['-- c'], SEGMENT_TOKENS['line_comment'])
+        self.assertEqual(tokens[' '], TEXT)
+
+    def test_is_query(self):
+        self.assertTrue(self.tokenizer.is_query("SELECT 1"))
+        self.assertTrue(self.tokenizer.is_query("-- comment\n(select 1)"))
+        self.assertTrue(self.tokenizer.is_query("WITH a AS (SELECT 1) SELECT * FROM a"))
+        self.assertFalse(self.tokenizer.is_query("CREATE TABLE t (a int)"))
+        self.assertFalse(self.tokenizer.is_query("-- SELECT"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Fast SQL Layer
+
+Keeps how long the plugin spent importing its modules and setting itself
+up, so that its start-up overhead can be measured.
+
+Licensed under the terms of GNU GPL v2 (or any later version)
+"""
+
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# what -> seconds, in the order things happened
+TIMINGS = OrderedDict()
+# what -> how many timed() blocks it was nested in, see total()
+DEPTHS = {}
+
+_nesting = threading.local()
+
+
+def record(what, seconds, depth=0):
+    TIMINGS[what] = TIMINGS.get(what, 0.0) + seconds
+    DEPTHS.setdefault(what, depth)
+
+
+@contextmanager
+def timed(what):
+    """ records the time spent in the with block """
+    depth = getattr(_nesting, 'depth', 0)
+    _nesting.depth = depth + 1
+    # listed in the order the blocks start, before the nested ones
+    TIMINGS.setdefault(what, 0.0)
+    started = time.time()
+    try:
+        yield
+    finally:
+        _nesting.depth = depth
+        record(what, time.time() - started, depth)
+
+
+def importModule(name, package=None):
+    """ importlib.import_module(), timed """
+    with timed("import " + name.lstrip('.')):
+        return importlib.import_module(name, package)
+
+
+def total():
+    """ the time of the top level timings only, the nested ones are part of them """
+    return sum([seconds for what, seconds in TIMINGS.items() if DEPTHS.get(what, 0) == 0])
+
+
+def report():
+    """ the timings as text, one per line, the nested ones indented """
+    lines = ["%-40s %7.1f ms" % ("  " * DEPTHS.get(what, 0) + what, seconds * 1000) for what, seconds in TIMINGS.items()]
+    lines.append("%-40s %7.1f ms" % ("total", total() * 1000))
+    return "\n".join(lines)